@@ -26,25 +26,68 @@ defaults = {
     "sisyphus/TEACHER_ARCHIVE_LIFETIME": datetime.timedelta(minutes = 2),
     "sisyphus/TEACHER_CSV_LIFETIME": datetime.timedelta(minutes = 2),
     "sheep/NCONSUMERS": 1,
+    "sheep/NPRODUCERS": 1,
+    "sheep/MULTIPLEX_CONSUMERS": False,
+    "sheep/WIRE_FORMAT": "json",
+    "sheep/MAX_MESSAGE_SIZE": 64 * 1024,
+    "sheep/RESULT_CHUNK_SIZE": 256 * 1024,
     "sheep/VIRTUAL_SUITE": "dummy",
     "sheep/vz/OS_TEMPLATE": "centos-6-x86_64",
     "sheep/vz/MAX_MACHINES": 2,
     "sheep/vz/LOW_MACHINE_THRESHOLD": 1,
+    "sheep/vz/ADAPTIVE_POOL": False,
+    "sheep/vz/MIN_MACHINES": 1,
+    "sheep/vz/POOL_RATE_WINDOW": datetime.timedelta(minutes = 5),
+    "sheep/vz/POOL_HEADROOM": 1.5,
+    "sheep/vz/POOL_SHRINK_DELAY": datetime.timedelta(minutes = 5),
     "sheep/vz/LOW_MACHINE_PERIOD": datetime.timedelta(minutes = 1),
     "sheep/vz/VZCTL_RETRY_TIMEOUT": datetime.timedelta(seconds = 30),
-    "sheep/vz/CALL_MKDIR": True,
     "sheep/vz/VM_TESTABLES_DIRECTORY": "/tmp/testables/",
     "sheep/vz/VM_HARNESS_DIRECTORY": "/tmp/harness/",
     "sheep/vz/BOOTSTRAPPER": "/vagrant/galah/galah/sheep/virtualsuites/vz/bootstrapper.py",
     "sheep/vz/TESTUSER_UID": 1000,
     "sheep/vz/TESTUSER_GID": 1000,
     "sheep/vz/VM_SUBNET": "10.0.1",
+    "sheep/vz/CTID_RANGE": (1, 254),
     "sheep/vz/VM_PORT": 6668, # Must be changed in the bootstrapper as well.
+    "sheep/vz/RECYCLE_CONTAINERS": False,
+    "sheep/vz/MAX_RESULT_SIZE": 64 * 1024 * 1024,
+    "sheep/vz/RESULT_SPOOL_SIZE": 1024 * 1024,
     "shepherd/SHEEP_SOCKET": "ipc:///tmp/shepherd-sheep.sock",
     "shepherd/PUBLIC_SOCKET": "ipc:///tmp/shepherd-public.sock",
+    "shepherd/STATS_SOCKET": "ipc:///tmp/shepherd-stats.sock",
+    "shepherd/SHARDS": None,
+    "shepherd/SHARD_LIVENESS_TTL": datetime.timedelta(seconds = 10),
+    "shepherd/SHARD_PROBE_TIMEOUT": datetime.timedelta(milliseconds = 500),
+    "shepherd/QUEUE_STATUS_TTL": datetime.timedelta(seconds = 10),
+    "shepherd/QUEUE_STATUS_TIMEOUT": datetime.timedelta(milliseconds = 100),
     "shepherd/REQUEST_QUEUE_TIMEOUT": datetime.timedelta(minutes = 1),
     "shepherd/SERVICE_TIMEOUT": datetime.timedelta(minutes = 1),
-    "shepherd/BLEET_TIMEOUT":  datetime.timedelta(seconds = 30)
+    "shepherd/SERVICE_TIMEOUT_GRACE": datetime.timedelta(seconds = 30),
+    "shepherd/BLEET_TIMEOUT":  datetime.timedelta(seconds = 30),
+    "shepherd/TIMEOUT_TRACKER": "heap",
+    "shepherd/TIMER_WHEEL_RESOLUTION": datetime.timedelta(seconds = 1),
+    "shepherd/REQUEST_JOURNAL": None,
+    "shepherd/REQUEST_JOURNAL_FSYNC": False,
+    "shepherd/DEADLINE_PRIORITY_HORIZON": datetime.timedelta(hours = 1),
+    "shepherd/DEADLINE_PRIORITY_WEIGHT": 0.05,
+    "shepherd/PRIORITY_CLASS_DELAYS": {
+        "final": datetime.timedelta(0),
+        "public": datetime.timedelta(minutes = 5),
+        "rerun": datetime.timedelta(hours = 1)
+    },
+    "shepherd/DOCUMENT_CACHE_SIZE": 1024,
+    "shepherd/DOCUMENT_CACHE_TTL": datetime.timedelta(seconds = 30),
+    "shepherd/RESULT_QUEUE_SIZE": 1000,
+    "shepherd/RESULT_BATCH_SIZE": 50,
+    "shepherd/RESULT_WRITE_ATTEMPTS": 8,
+    "shepherd/MAX_OVERFLOW_SIZE": 64 * 1024 * 1024,
+    "shepherd/SOCKET_DRAIN_BUDGET": 100,
+    "shepherd/RERUN_QUEUE_LIMIT": 500,
+    "shepherd/MAX_QUEUE_DEPTH": 10000,
+    "shepherd/MAX_REQUEST_RETRIES": 3,
+    "shepherd/REQUEST_RETRY_BACKOFF": datetime.timedelta(seconds = 15),
+    "shepherd/DEAD_LETTER_LIMIT": 1000
 }
 
 import imp
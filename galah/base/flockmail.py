@@ -4,7 +4,7 @@ class FlockMessage:
     # Acceptable types for a shepherd/sheep to send or sheep/shepherd to
     # receive.
     shepherd_types = ("bloot", "identify", "request")
-    sheep_types = ("bleet", "environment", "distress", "result")
+    sheep_types = ("bleet", "environment", "distress", "result", "result_chunk")
 
     def __init__(self, type, body):
         self.type = type
@@ -25,21 +25,23 @@ class FlockMessage:
 class TestRequest:
     """
     A basic test request as the shepherd would receive it from the outside.
-    Contains only the submission id of the submission to test.
+    Contains only the submission id of the submission to test, and whether the
+    request is part of a bulk rerun (which is treated as background work).
 
     """
 
-    __slots__ = ("submission_id", )
+    __slots__ = ("submission_id", "rerun")
 
-    def __init__(self, submission_id):
+    def __init__(self, submission_id, rerun = False):
         self.submission_id = submission_id
+        self.rerun = rerun
 
     def to_dict(self):
-    	return {"submission_id": str(self.submission_id)}
+    	return {"submission_id": str(self.submission_id), "rerun": self.rerun}
 
     @staticmethod
     def from_dict(raw):
-    	return TestRequest(raw["submission_id"])
+    	return TestRequest(raw["submission_id"], raw.get("rerun", False))
 
 class InternalTestRequest:
     """
@@ -47,20 +49,52 @@ class InternalTestRequest:
     The shepherd (or whoever) transforms a TestRequest object into an
     InternalTestRequest object upon receival.
 
+    Two requests are equal if they are for the same submission and the same
+    test harness, regardless of any other attributes, so that duplicate
+    requests can be recognized.
+
     """
 
-    __slots__ = ("submission_id", "timeout", "environment")
+    __slots__ = ("submission_id", "timeout", "environment", "deadline",
+                 "retries", "harness_id", "priority_class", "assignment_id")
 
-    def __init__(self, submission_id, timeout, environment):
+    def __init__(self, submission_id, timeout, environment, deadline = None,
+            retries = 0, harness_id = None, priority_class = None,
+            assignment_id = None):
         self.submission_id = submission_id
         self.timeout = timeout
         self.environment = environment
 
+        # The id of the test harness the submission will be tested with. A new
+        # harness gets a new id, so this serves as the harness's version.
+        self.harness_id = harness_id
+
+        # When the assignment the submission belongs to is due (a datetime) or
+        # None. Used to prioritize requests as the deadline approaches.
+        self.deadline = deadline
+
+        # The number of times this request has been requeued because the
+        # sheep servicing it died.
+        self.retries = retries
+
+        # One of "final", "public", or "rerun" (or None if unknown). Decides
+        # how urgently the request is dispatched.
+        self.priority_class = priority_class
+
+        # The id of the assignment the submission belongs to (or None if
+        # unknown).
+        self.assignment_id = assignment_id
+
     def to_dict(self):
         return {
             "submission_id": self.submission_id,
             "timeout": self.timeout,
-            "environment": self.environment
+            "environment": self.environment,
+            "deadline": self.deadline,
+            "retries": self.retries,
+            "harness_id": self.harness_id,
+            "priority_class": self.priority_class,
+            "assignment_id": self.assignment_id
         }
 
     @staticmethod
@@ -68,5 +102,34 @@ class InternalTestRequest:
         return InternalTestRequest(
             raw["submission_id"],
             raw["timeout"],
-            raw["environment"]
+            raw["environment"],
+            raw.get("deadline"),
+            raw.get("retries", 0),
+            raw.get("harness_id"),
+            raw.get("priority_class"),
+            raw.get("assignment_id")
         )
+
+    def _key(self):
+        # Ids may be ObjectIds or strings depending on where the request came
+        # from.
+        return (
+            str(self.submission_id),
+            None if self.harness_id is None else str(self.harness_id)
+        )
+
+    def __eq__(self, other):
+        if not isinstance(other, InternalTestRequest):
+            return NotImplemented
+
+        return self._key() == other._key()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+
+        return not result
+
+    def __hash__(self):
+        return hash(self._key())
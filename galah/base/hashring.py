@@ -0,0 +1,79 @@
+from bisect import bisect
+import hashlib
+
+class HashRing:
+    """
+    Maps keys onto a set of nodes by consistent hashing. Each node is placed at
+    many points around a ring of hashes, and a key belongs to the first node
+    found going clockwise from the key's own hash.
+
+    Adding or removing a node only moves the keys that node gains or loses,
+    everything else stays put. Used to decide which shepherd owns which
+    assignments.
+
+    """
+
+    def __init__(self, nodes = (), replicas = 100):
+        # The number of points each node is placed at. More points spread keys
+        # more evenly.
+        self.replicas = replicas
+
+        # The sorted hashes of every point on the ring, and the node at each
+        # point.
+        self._hashes = []
+        self._nodes = {}
+
+        for i in nodes:
+            self.add_node(i)
+
+    @staticmethod
+    def _hash(value):
+        return long(hashlib.md5(str(value)).hexdigest()[:16], 16)
+
+    @property
+    def nodes(self):
+        return set(self._nodes.values())
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add_node(self, node):
+        for i in xrange(self.replicas):
+            point = HashRing._hash("%s#%d" % (node, i))
+            if point not in self._nodes:
+                self._hashes.insert(bisect(self._hashes, point), point)
+
+            self._nodes[point] = node
+
+    def remove_node(self, node):
+        self._hashes = [i for i in self._hashes if self._nodes[i] != node]
+        self._nodes = dict(
+            (k, v) for k, v in self._nodes.items() if v != node
+        )
+
+    def iter_nodes(self, key):
+        """
+        Yields every node once, starting with the node that owns key and
+        continuing around the ring. If the owner is unavailable, the next node
+        yielded is the one that would own key without it.
+
+        """
+
+        if not self._hashes:
+            return
+
+        start = bisect(self._hashes, HashRing._hash(key))
+        seen = set()
+        for i in xrange(len(self._hashes)):
+            node = self._nodes[self._hashes[(start + i) % len(self._hashes)]]
+            if node not in seen:
+                seen.add(node)
+                yield node
+
+    def get_node(self, key):
+        """Returns the node that owns key, or None if there are no nodes."""
+
+        for i in self.iter_nodes(key):
+            return i
+
+        return None
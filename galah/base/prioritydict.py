@@ -100,3 +100,189 @@ class PriorityDict(dict):
         
         while self:
             yield self.pop_smallest()
+
+class IndexedPriorityDict(dict):
+    """
+    Dictionary that can be used as a priority queue, like PriorityDict, but
+    backed by a binary heap that tracks the position of every key.
+
+    Updating or removing a key moves its entry within the heap in O(log n)
+    rather than leaving a stale entry behind, so the heap never holds more
+    than one entry per key and never needs to be rebuilt. This makes it the
+    better choice when priorities are updated far more often than items are
+    popped (ex: sheep bleeting).
+
+    Only priorities are compared, never keys, so items with equal priorities
+    come out in no particular order. Priorities are compared very often, so
+    prefer cheap types (ex: floats of seconds since the epoch rather than
+    datetimes).
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(IndexedPriorityDict, self).__init__()
+
+        # A binary heap of [priority, key] lists.
+        self._heap = []
+
+        # Maps every key to the index of its entry in the heap.
+        self._position = {}
+
+        self.update(*args, **kwargs)
+
+    def _sift_up(self, i):
+        heap = self._heap
+        position = self._position
+        entry = heap[i]
+        priority = entry[0]
+
+        while i > 0:
+            parent = (i - 1) >> 1
+            parent_entry = heap[parent]
+            if not priority < parent_entry[0]:
+                break
+
+            heap[i] = parent_entry
+            position[parent_entry[1]] = i
+            i = parent
+
+        heap[i] = entry
+        position[entry[1]] = i
+
+    def _sift_down(self, i):
+        heap = self._heap
+        position = self._position
+        size = len(heap)
+        entry = heap[i]
+        priority = entry[0]
+
+        child = 2 * i + 1
+        while child < size:
+            # Pick the smaller of the two children.
+            child_entry = heap[child]
+            right = child + 1
+            if right < size and heap[right][0] < child_entry[0]:
+                child = right
+                child_entry = heap[right]
+
+            if not child_entry[0] < priority:
+                break
+
+            heap[i] = child_entry
+            position[child_entry[1]] = i
+            i = child
+            child = 2 * i + 1
+
+        heap[i] = entry
+        position[entry[1]] = i
+
+    def _remove_at(self, i):
+        heap = self._heap
+        del self._position[heap[i][1]]
+
+        last = heap.pop()
+        if i < len(heap):
+            # Fill the hole with the last entry and move it to wherever it
+            # belongs.
+            heap[i] = last
+            self._position[last[1]] = i
+            self._sift_down(i)
+            self._sift_up(self._position[last[1]])
+
+    def smallest(self):
+        """
+        Return the item with the lowest priority as a named tuple
+        (priority, value).
+
+        Raises IndexError if the object is empty.
+
+        """
+
+        priority, key = self._heap[0]
+        return PriorityValuePair(priority, key)
+
+    def pop_smallest(self):
+        """
+        Return the item as a named tuple (priority, value) with the lowest
+        priority and remove it.
+
+        Raises IndexError if the object is empty.
+
+        """
+
+        priority, key = self._heap[0]
+        del self[key]
+        return PriorityValuePair(priority, key)
+
+    def __setitem__(self, key, val):
+        super(IndexedPriorityDict, self).__setitem__(key, val)
+
+        i = self._position.get(key)
+        if i is None:
+            self._heap.append([val, key])
+            self._sift_up(len(self._heap) - 1)
+        else:
+            old = self._heap[i][0]
+            self._heap[i][0] = val
+
+            if val < old:
+                self._sift_up(i)
+            else:
+                self._sift_down(i)
+
+    def __delitem__(self, key):
+        super(IndexedPriorityDict, self).__delitem__(key)
+        self._remove_at(self._position[key])
+
+    def pop(self, key, *default):
+        if key not in self:
+            if default:
+                return default[0]
+
+            raise KeyError(key)
+
+        val = self[key]
+        del self[key]
+        return val
+
+    def popitem(self):
+        if not self:
+            raise KeyError("popitem(): dictionary is empty")
+
+        priority, key = self.pop_smallest()
+        return key, priority
+
+    def clear(self):
+        super(IndexedPriorityDict, self).clear()
+        self._heap = []
+        self._position = {}
+
+    def setdefault(self, key, val):
+        if key not in self:
+            self[key] = val
+            return val
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        # Rebuild the heap from scratch rather than pushing every item onto
+        # it. A sorted list is a valid heap, and sorting by priority alone
+        # keeps keys from ever being compared.
+        super(IndexedPriorityDict, self).update(*args, **kwargs)
+
+        self._heap = [[v, k] for k, v in self.iteritems()]
+        self._heap.sort(key = lambda i: i[0])
+        self._position = dict(
+            (entry[1], i) for i, entry in enumerate(self._heap)
+        )
+
+    def copy(self):
+        return IndexedPriorityDict(self)
+
+    def sorted_iter(self):
+        """Sorted iterator of the priority dictionary items.
+
+        Beware: this will destroy elements as they are returned.
+        """
+
+        while self:
+            yield self.pop_smallest()
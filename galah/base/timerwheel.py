@@ -0,0 +1,218 @@
+"""
+Structures for keeping track of many timeouts (ex: one per sheep) that are
+refreshed much more often than they expire.
+
+Both HeapTimeouts and TimerWheel map keys to deadlines and share the same
+interface, so either can be used wherever the other is. Deadlines are in
+seconds as given by monotonic(), which never jumps around when the system clock
+is changed.
+
+"""
+
+from galah.base.prioritydict import IndexedPriorityDict
+import time
+
+def _monotonic_clock():
+    """
+    Returns a function that reads a monotonic clock, falling back to the system
+    clock if no monotonic clock can be found.
+
+    """
+
+    # Python 3.3 and later have one built in.
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+        # clock_gettime() lives in librt with older versions of glibc.
+        library = ctypes.CDLL(
+            ctypes.util.find_library("rt") or ctypes.util.find_library("c"),
+            use_errno = True
+        )
+        clock_gettime = library.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+        CLOCK_MONOTONIC = 1
+
+        def monotonic():
+            now = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(now)) != 0:
+                raise OSError(ctypes.get_errno(), "clock_gettime failed")
+
+            return now.tv_sec + now.tv_nsec * 1e-9
+
+        # Make sure it actually works before handing it out.
+        monotonic()
+
+        return monotonic
+    except (ImportError, OSError, AttributeError):
+        return time.time
+
+monotonic = _monotonic_clock()
+
+class HeapTimeouts(IndexedPriorityDict):
+    """
+    Tracks timeouts with a binary heap. Refreshing a timeout costs O(log n),
+    but expired timeouts are found exactly and in order.
+
+    """
+
+    def next_expiry(self):
+        """
+        Returns the earliest deadline, or None if nothing will ever expire.
+
+        """
+
+        if not self:
+            return None
+
+        deadline = self.smallest().priority
+        return None if deadline == float("inf") else deadline
+
+    def pop_expired(self, now):
+        """
+        Removes and returns a list of every key whose deadline is not after
+        now, earliest first.
+
+        """
+
+        expired = []
+        while self and self.smallest().priority <= now:
+            expired.append(self.pop_smallest().value)
+
+        return expired
+
+class TimerWheel(object):
+    """
+    Tracks timeouts with a hashed timing wheel. Time is divided into ticks of
+    resolution seconds, and every key is placed in the bucket for the tick its
+    deadline falls in, with the buckets reused every slots ticks.
+
+    Refreshing a timeout moves the key between two buckets, which costs O(1)
+    no matter how many keys there are. Sweeping for expired keys only looks at
+    the buckets for the ticks that have passed, so it costs O(expired) as long
+    as few keys have deadlines more than resolution * slots seconds away (those
+    keys are looked at, but left alone, every time their bucket comes around).
+
+    The price is precision. next_expiry() only knows which tick the earliest
+    deadline falls in, so deadlines are noticed up to resolution seconds late.
+
+    """
+
+    def __init__(self, resolution = 1.0, slots = 512, clock = monotonic):
+        self.resolution = float(resolution)
+        self.slots = slots
+
+        # Each bucket maps keys to their deadlines.
+        self._buckets = [{} for _ in xrange(slots)]
+
+        # Maps every key to a (deadline, bucket index) tuple. Keys that will
+        # never expire have a deadline of infinity and aren't in any bucket.
+        self._deadlines = {}
+
+        # The number of keys in the buckets.
+        self._scheduled = 0
+
+        # The tick that was current as of the last sweep. Every bucket for an
+        # earlier tick has been swept.
+        self._tick = self._tick_of(clock())
+
+    def _tick_of(self, deadline):
+        return int(deadline // self.resolution)
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __nonzero__(self):
+        return bool(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def __iter__(self):
+        return iter(self._deadlines)
+
+    def __getitem__(self, key):
+        return self._deadlines[key][0]
+
+    def __setitem__(self, key, deadline):
+        if key in self._deadlines:
+            del self[key]
+
+        if deadline == float("inf"):
+            self._deadlines[key] = (deadline, None)
+            return
+
+        # Deadlines that have already passed go in the bucket for the current
+        # tick so the next sweep picks them up.
+        index = max(self._tick_of(deadline), self._tick) % self.slots
+
+        self._buckets[index][key] = deadline
+        self._deadlines[key] = (deadline, index)
+        self._scheduled += 1
+
+    def __delitem__(self, key):
+        _, index = self._deadlines.pop(key)
+
+        if index is not None:
+            del self._buckets[index][key]
+            self._scheduled -= 1
+
+    def next_expiry(self):
+        """
+        Returns a time by which the earliest deadline will have passed, or
+        None if nothing will ever expire. This is the end of the earliest tick
+        with a bucket that isn't empty, so it may arrive without anything
+        having expired.
+
+        """
+
+        if not self._scheduled:
+            return None
+
+        for tick in xrange(self._tick, self._tick + self.slots):
+            if self._buckets[tick % self.slots]:
+                return (tick + 1) * self.resolution
+
+        # Every scheduled key is in some bucket, so we can't get here.
+        raise AssertionError("Scheduled keys missing from the timer wheel.")
+
+    def pop_expired(self, now):
+        """
+        Removes and returns a list of every key whose deadline is not after
+        now, in no particular order.
+
+        """
+
+        now_tick = self._tick_of(now)
+
+        if now_tick - self._tick >= self.slots:
+            indexes = xrange(self.slots)
+        else:
+            indexes = (i % self.slots for i in xrange(self._tick, now_tick + 1))
+
+        expired = []
+        for index in indexes:
+            bucket = self._buckets[index]
+            if not bucket:
+                continue
+
+            for key, deadline in bucket.items():
+                if deadline <= now:
+                    del bucket[key]
+                    del self._deadlines[key]
+                    expired.append(key)
+
+        self._scheduled -= len(expired)
+
+        # The current tick's bucket is swept again next time since more of it
+        # may expire before the tick is over.
+        self._tick = max(self._tick, now_tick)
+
+        return expired
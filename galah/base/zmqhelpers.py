@@ -1,4 +1,79 @@
 from zmq.utils import jsonapi
+import struct
+
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+# Messages in any wire format other than JSON begin with a version byte that
+# names the format (and the version of it). A JSON document can never begin
+# with one of these bytes, so anyone receiving a message can tell what it's
+# looking at and peers that only speak JSON keep working.
+MSGPACK_V1 = "\x01"
+
+WIRE_FORMATS = ("json", "msgpack")
+
+# Bleets and bloots (heartbeats) are sent far more often than anything else, so
+# rather than being encoded like other messages they are sent as control
+# frames: a single byte saying what the frame is, followed for bleets by the
+# number of free slots (see BLEET_SLOTS) and for bloots by the shepherd's queue
+# depth (see BLOOT_QUEUE_DEPTH), if the sender has anything to say about that.
+# Control frames carry no body and can be recognized without decoding
+# anything.
+BLEET_FRAME = "\x10"
+BLOOT_FRAME = "\x11"
+
+BLEET_SLOTS = struct.Struct("!H")
+BLOOT_QUEUE_DEPTH = struct.Struct("!I")
+
+def bleet_frame(free_slots = None):
+	"""
+	Returns a bleet control frame, optionally telling the shepherd how many
+	requests the sender is ready for.
+
+	"""
+
+	if free_slots is None:
+		return BLEET_FRAME
+
+	return BLEET_FRAME + BLEET_SLOTS.pack(min(free_slots, 0xFFFF))
+
+def parse_bleet_frame(raw):
+	"""
+	Returns the number of free slots given in a bleet control frame, or None
+	if there is none.
+
+	"""
+
+	if len(raw) == 1 + BLEET_SLOTS.size:
+		return BLEET_SLOTS.unpack_from(raw, 1)[0]
+
+	return None
+
+def bloot_frame(queue_depth = None):
+	"""
+	Returns a bloot control frame, optionally telling the sheep how many test
+	requests are waiting in the shepherd's queue.
+
+	"""
+
+	if queue_depth is None:
+		return BLOOT_FRAME
+
+	return BLOOT_FRAME + BLOOT_QUEUE_DEPTH.pack(min(queue_depth, 0xFFFFFFFF))
+
+def parse_bloot_frame(raw):
+	"""
+	Returns the queue depth given in a bloot control frame, or None if there
+	is none.
+
+	"""
+
+	if len(raw) == 1 + BLOOT_QUEUE_DEPTH.size:
+		return BLOOT_QUEUE_DEPTH.unpack_from(raw, 1)[0]
+
+	return None
 
 def jsonify(item):
 	"""
@@ -16,6 +91,64 @@ def dejsonify(raw):
 
 	return jsonapi.loads(raw)
 
+def encode(item, wire_format = "json"):
+	"""
+	Serializes an object in the given wire format (one of WIRE_FORMATS).
+
+	"""
+
+	if wire_format == "json":
+		return jsonify(item)
+	elif wire_format == "msgpack":
+		if msgpack is None:
+			raise ValueError("The msgpack wire format requires msgpack.")
+
+		return MSGPACK_V1 + msgpack.packb(item, use_bin_type = True)
+	else:
+		raise ValueError("Unknown wire format %s." % repr(wire_format))
+
+def decode(raw):
+	"""
+	Deserializes a message in any wire format. Returns a tuple of the object
+	and the name of the wire format it was in, so replies can be sent back in
+	kind.
+
+	Control frames are decoded into the equivalent message for the sake of
+	anyone not bothering with them, but their wire format is None since they
+	don't say anything about how the sender wants to be spoken to. Anything
+	that handles many heartbeats should check for them before decoding.
+
+	"""
+
+	if raw[:1] == BLEET_FRAME:
+		free_slots = parse_bleet_frame(raw)
+		return ({
+			"type": "bleet",
+			"body": "" if free_slots is None else free_slots
+		}, None)
+	elif raw[:1] == BLOOT_FRAME:
+		queue_depth = parse_bloot_frame(raw)
+		return ({
+			"type": "bloot",
+			"body": "" if queue_depth is None else queue_depth
+		}, None)
+	elif raw[:1] == MSGPACK_V1:
+		if msgpack is None:
+			raise ValueError("Received msgpack but msgpack isn't installed.")
+
+		# Text comes back as unicode, the same as with JSON.
+		return (msgpack.unpackb(raw[1:], raw = False), "msgpack")
+
+	return (dejsonify(raw), "json")
+
+def send_message(socket, message, wire_format = "json"):
+	socket.send(encode(message, wire_format))
+
+def recv_message(socket):
+	"""Receives a message in any wire format. See decode()."""
+
+	return decode(socket.recv())
+
 def router_send(socket, identify, message):
 	socket.send_multipart([identify, message])
 
@@ -40,3 +173,18 @@ def router_recv_json(socket, allow_multiple_identities = False):
 	identities, message = router_recv(socket, allow_multiple_identities)
 
 	return (identities, dejsonify(message))
+
+def router_send_message(socket, identity, message, wire_format = "json"):
+	router_send(socket, identity, encode(message, wire_format))
+
+def router_recv_message(socket, allow_multiple_identities = False):
+	"""
+	Receives a message in any wire format. Returns a tuple of the identity (or
+	identities), the message, and its wire format.
+
+	"""
+
+	identities, message = router_recv(socket, allow_multiple_identities)
+	message, wire_format = decode(message)
+
+	return (identities, message, wire_format)
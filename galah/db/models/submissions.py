@@ -45,6 +45,15 @@ class TestResult(Document):
     # TestResult object.
     failed = BooleanField()
 
+    # Set to true (along with failed) if the shepherd was too backed up to
+    # accept the test request, in which case the tests were never run.
+    rejected = BooleanField()
+
+    # The full text of any test messages that were too long to be stored here
+    # (and were truncated), as a JSON document mapping the index of each such
+    # test to its message. Stored in GridFS.
+    overflow = FileField()
+
     meta = {
         "allow_inheritance": False
     }
@@ -1,3 +1,4 @@
 import consumer
 import maintainer
 import producer
+import multiplexer
@@ -2,7 +2,10 @@ import zmq
 import galah.sheep.utility.universal as universal
 import galah.sheep.utility.exithelpers as exithelpers
 from galah.sheep.utility.suitehelpers import get_virtual_suite
+from galah.sheep.utility.results import split_overflow, chunk
 from galah.base.flockmail import FlockMessage
+from galah.base.zmqhelpers import decode, parse_bloot_frame, BLEET_FRAME, \
+    BLOOT_FRAME
 import time
 import threading
 import logging
@@ -31,10 +34,16 @@ def _run():
     virtual_suite = get_virtual_suite(config["VIRTUAL_SUITE"])
     consumer = virtual_suite.Consumer(logger)
 
-    # Set up the socket to send/receive messages to/from the shepherd
+    # Set up the socket to send/receive messages to/from the shepherd (or the
+    # multiplexer, which speaks to every shepherd on our behalf).
     shepherd = universal.context.socket(zmq.DEALER)
     shepherd.linger = 0
-    shepherd.connect(config["shepherd/SHEEP_SOCKET"])
+    if universal.multiplexing():
+        shepherd_address = universal.MULTIPLEXER_ADDRESS
+    else:
+        shepherd_address = universal.shepherd_addresses()[0]
+
+    shepherd.connect(shepherd_address)
 
     # Loop until the program is shutting down
     while not universal.exiting:
@@ -44,7 +53,7 @@ def _run():
         machine_id = consumer.prepare_machine()
 
         def bleet():
-            shepherd.send_json(FlockMessage("bleet", "").to_dict())
+            shepherd.send(BLEET_FRAME)
 
             # Figure out when we should send the next bleet
             return (
@@ -63,16 +72,14 @@ def _run():
         # Process traffic from shepherd.
         while True:
             try:
-                message = exithelpers.recv_json(
+                raw_message = exithelpers.recv_raw(
                     shepherd,
                     timeout = max(
                         1, # 1 millisecond (0 would imply infinite timeout)
                         (next_bleet_time - datetime.datetime.now()).seconds
                             * 1000
                     )
-                )
-
-                message = FlockMessage(message["type"], message["body"])
+                )[-1]
             except exithelpers.Timeout:
                 if not shepherd_blooted:
                     raise universal.ShepherdLost()
@@ -83,7 +90,26 @@ def _run():
 
                 continue
 
+            # Bloots are by far the most common thing we'll hear, so they're
+            # handled without decoding anything.
+            if raw_message[:1] == BLOOT_FRAME:
+                logger.debug("Got bloot.")
+                shepherd_blooted = True
+
+                # The multiplexer keeps track of the queue depth itself when
+                # it's in use.
+                if not universal.multiplexing():
+                    universal.note_queue_depth(
+                        shepherd_address, parse_bloot_frame(raw_message)
+                    )
+
+                continue
+
+            message, _ = decode(raw_message)
+            message = FlockMessage(message["type"], message["body"])
+
             if message.type == "bloot":
+                # An older shepherd, or one answering a distress message.
                 logger.debug("Got bloot.")
                 shepherd_blooted = True
 
@@ -100,7 +126,7 @@ def _run():
                     body = universal.environment
                 )
 
-                shepherd.send_json(identification.to_dict())
+                exithelpers.send_message(shepherd, identification.to_dict())
 
             elif message.type == "request":
                 # Received test request from the shepherd
@@ -118,9 +144,27 @@ def _run():
                 # Add in the submission id to the result that we send back
                 result["id"] = str(message.body["submission"]["id"])
 
+                # Any messages too long to send along with the result are
+                # truncated, and sent in full ahead of it in pieces.
+                result, overflow = \
+                    split_overflow(result, config["MAX_MESSAGE_SIZE"])
+                overflow_chunks = \
+                    chunk(overflow, config["RESULT_CHUNK_SIZE"]) if overflow \
+                    else []
+
+                for index, data in enumerate(overflow_chunks):
+                    exithelpers.send_message(shepherd, FlockMessage(
+                        "result_chunk",
+                        {"id": result["id"], "index": index, "data": data}
+                    ).to_dict())
+
+                result["overflow_chunks"] = len(overflow_chunks)
+
                 logger.info("Testing completed, sending results to shepherd.")
                 logger.debug("Raw test results: %s", str(result))
-                shepherd.send_json(FlockMessage("result", result).to_dict())
+                exithelpers.send_message(
+                    shepherd, FlockMessage("result", result).to_dict()
+                )
 
                 # Wait for the shepherd to acknowledge the result. Ignore any
                 # messages that we get from the shepherd besides an acknowledge.
@@ -128,21 +172,28 @@ def _run():
                     datetime.datetime.now() + datetime.timedelta(seconds = 30)
                 while True:
                     try:
-                        confirmation = exithelpers.recv_json(
+                        raw_confirmation = exithelpers.recv_raw(
                             shepherd,
                             timeout = max(
                                 1, # 1 millisecond (0 would imply infinite timeout)
                                 (deadline - datetime.datetime.now()).seconds
                                     * 1000
                             )
-                        )
-
-                        confirmation = FlockMessage(
-                            confirmation["type"], confirmation["body"]
-                        )
+                        )[-1]
                     except exithelpers.Timeout:
                         raise universal.ShepherdLost(result = result)
 
+                    # The acknowledgement is a bloot carrying the submission's
+                    # id, so it's never a control frame. Those are only
+                    # heartbeats and can be skipped without decoding them.
+                    if raw_confirmation[:1] == BLOOT_FRAME:
+                        continue
+
+                    confirmation, _ = decode(raw_confirmation)
+                    confirmation = FlockMessage(
+                        confirmation["type"], confirmation["body"]
+                    )
+
                     logger.debug("Received message: %s", str(confirmation))
 
                     if confirmation.type == "bloot" and \
@@ -2,9 +2,11 @@ import galah.sheep.utility.universal as universal
 import galah.sheep.utility.exithelpers as exithelpers
 from galah.base.flockmail import FlockMessage
 import threading
+import itertools
 import logging
 import consumer
 import producer
+import multiplexer
 import time
 import zmq
 
@@ -32,21 +34,48 @@ def start_consumer():
 
     return consumerThread
 
+# Ditto for producer threads.
+_producer_counter = 0
 def start_producer():
-    producer_thread = threading.Thread(target = producer.run, name = "producer")
+    global _producer_counter
+
+    producer_thread = threading.Thread(
+        target = producer.run, name = "producer-%d" % _producer_counter
+    )
     producer_thread.start()
 
+    _producer_counter += 1
+
     return producer_thread
 
+def start_multiplexer(nslots):
+    multiplexer_thread = threading.Thread(
+        target = multiplexer.run, args = (nslots, ), name = "multiplexer"
+    )
+    multiplexer_thread.start()
+
+    # Consumers can't connect until the multiplexer has bound its socket.
+    while not multiplexer.bound.wait(1):
+        if universal.exiting:
+            raise universal.Exiting()
+
+    return multiplexer_thread
+
 @universal.handleExiting
 def run(znconsumers):
     log = logging.getLogger("galah.sheep.maintainer")
 
     log.info("Maintainer starting")
 
-    producer = start_producer()
+    producers = []
     consumers = []
 
+    shepherd_addresses = itertools.cycle(universal.shepherd_addresses())
+
+    multiplexer_thread = None
+    if universal.multiplexing():
+        multiplexer_thread = start_multiplexer(znconsumers)
+
     # Continually make sure that all of the threads are up until it's time to
     # exit
     while not universal.exiting:
@@ -63,15 +92,20 @@ def run(znconsumers):
                 # be eaten by a defunct shepherd and then we'd be stuck forever.
                 shepherd = universal.context.socket(zmq.DEALER)
                 shepherd.linger = 0
-                shepherd.connect(config["shepherd/SHEEP_SOCKET"])
 
-                shepherd.send_json(FlockMessage("distress", "").to_dict())
+                # Any shepherd will take the results, so if there are several
+                # we try a different one every time.
+                shepherd.connect(next(shepherd_addresses))
+
+                exithelpers.send_message(
+                    shepherd, FlockMessage("distress", "").to_dict()
+                )
 
                 logger.info(
                     "Sent distress message to shepherd, waiting for response."
                 )
 
-                message = exithelpers.recv_json(shepherd, timeout = 1000 * 60)
+                message = exithelpers.recv_message(shepherd, timeout = 1000 * 60)
                 message = FlockMessage.from_dict(message)
 
                 if message.type == "bloot" and message.body == "":
@@ -79,11 +113,12 @@ def run(znconsumers):
                         result = universal.orphaned_results.get()
 
                         try:
-                            shepherd.send_json(
+                            exithelpers.send_message(
+                                shepherd,
                                 FlockMessage("result", result).to_dict()
                             )
 
-                            confirmation = exithelpers.recv_json(
+                            confirmation = exithelpers.recv_message(
                                 shepherd, timeout = 1000 * 5
                             )
                             confirmation = FlockMessage.from_dict(confirmation)
@@ -108,6 +143,14 @@ def run(znconsumers):
             except exithelpers.Timeout:
                 continue
 
+        # If the multiplexer died, start it again. Its consumers will notice
+        # it's gone when it doesn't bloot back, and will be restarted below.
+        if multiplexer_thread and not multiplexer_thread.isAlive():
+            log.warning("Found dead multiplexer, restarting it.")
+
+            multiplexer.bound.clear()
+            multiplexer_thread = start_multiplexer(znconsumers)
+
         # Remove any dead consumers from the list
         dead_consumers = 0
         for c in consumers[:]:
@@ -124,11 +167,21 @@ def run(znconsumers):
         while len(consumers) < znconsumers:
             consumers.append(start_consumer())
 
-        # If the producer died, start it again
-        if not producer.isAlive():
-            log.warning("Found dead producer, restarting it.")
+        # Remove any dead producers from the list
+        dead_producers = 0
+        for p in producers[:]:
+            if not p.isAlive():
+                dead_producers += 1
+                producers.remove(p)
+
+        if dead_producers > 0:
+            logger.warning(
+                "Found %d dead producers, restarting them.", dead_producers
+            )
 
-            producer = start_producer()
+        # Start up producers until we have the desired amount
+        while len(producers) < config["NPRODUCERS"]:
+            producers.append(start_producer())
 
         # Sleep for awhile
         time.sleep(poll_timeout)
@@ -0,0 +1,271 @@
+import galah.sheep.utility.universal as universal
+from galah.base.flockmail import FlockMessage
+import galah.sheep.utility.exithelpers as exithelpers
+from galah.base.zmqhelpers import router_send, router_recv, \
+    router_send_message, decode, bleet_frame, parse_bloot_frame, BLEET_FRAME, \
+    BLOOT_FRAME
+from collections import deque, OrderedDict
+import threading
+import datetime
+import logging
+import zmq
+
+# Load Galah's configuration.
+from galah.base.config import load_config
+config = load_config("sheep")
+
+logger = logging.getLogger("galah.sheep.multiplexer")
+
+# Set once the multiplexer is accepting connections from consumers. inproc
+# sockets must be bound before anyone connects to them.
+bound = threading.Event()
+
+def _connect_to_shepherd(address):
+    shepherd = universal.context.socket(zmq.DEALER)
+    shepherd.linger = 0
+    shepherd.connect(address)
+
+    return shepherd
+
+def _split_slots(free_slots, addresses, turn):
+    """
+    Divides free_slots between the shepherds at the given addresses so that
+    no two shepherds are offered the same consumer. Returns a dict mapping
+    each address to its share.
+
+    Slots that can't be divided evenly go to the shepherds with the most
+    requests waiting (as told to us in their bloots) first. Ties are broken
+    by taking turns, turn being incremented by the caller every time, so a
+    quiet shepherd isn't left out forever.
+
+    """
+
+    share, remainder = divmod(free_slots, len(addresses))
+    shares = dict((i, share) for i in addresses)
+
+    start = turn % len(addresses)
+    in_turn = addresses[start:] + addresses[:start]
+
+    # sort() is stable, so shepherds with the same queue depth stay in turn.
+    in_turn.sort(
+        key = lambda i: -(universal.shepherd_queue_depths.get(i) or 0)
+    )
+
+    for i in in_turn[:remainder]:
+        shares[i] += 1
+
+    return shares
+
+@universal.handleExiting
+def run(nslots):
+    """
+    Speaks to the shepherd on behalf of every consumer in this sheep over a
+    single connection.
+
+    Each consumer connects to the multiplexer instead of the shepherd and
+    speaks the same protocol it would speak to the shepherd. The multiplexer
+    answers their bleets itself and tells the shepherd, in its own bleets, how
+    many consumers are ready for a request. The shepherd then sees one sheep
+    with nslots slots rather than nslots sheep.
+
+    When there are several shepherds (see shepherd/SHARDS) the multiplexer
+    speaks to all of them, and sends each result back to the shepherd the
+    request came from. Our free slots are divided between the shepherds (see
+    _split_slots()) so they don't all send requests for the same consumer.
+
+    """
+
+    logger.info("Multiplexer starting.")
+
+    consumers = universal.context.socket(zmq.ROUTER)
+    consumers.linger = 0
+    consumers.bind(universal.MULTIPLEXER_ADDRESS)
+    bound.set()
+
+    # Make sure the address is freed up if we die so we can be restarted.
+    try:
+        _run(nslots, consumers)
+    finally:
+        consumers.close()
+
+def _run(nslots, consumers):
+    poller = zmq.Poller()
+    poller.register(consumers, zmq.POLLIN)
+
+    # Maps the address of every shepherd to our socket connected to it.
+    shepherds = {}
+    for address in universal.shepherd_addresses():
+        shepherds[address] = _connect_to_shepherd(address)
+        poller.register(shepherds[address], zmq.POLLIN)
+
+    # Maps the identities of consumers that are waiting for a request to the
+    # last time they bleeted, longest waiting first.
+    idle = OrderedDict()
+
+    # Requests the shepherds sent before a consumer was ready for them.
+    pending = deque()
+
+    # Maps submission ids to the address of the shepherd that sent the
+    # request for that submission.
+    origins = {}
+
+    # Maps submission ids to the consumer waiting for the shepherd to
+    # acknowledge the result for that submission.
+    awaiting_ack = {}
+
+    next_bleet_time = datetime.datetime.now()
+
+    # The shepherds that have answered since we last bleeted.
+    blooted = set(shepherds)
+
+    # Set whenever we have more free slots than we last told the shepherds
+    # about, so we can tell them right away rather than at the next bleet.
+    slots_freed = False
+
+    # The number of bleets sent, used to take turns in _split_slots().
+    bleets_sent = 0
+
+    while not universal.exiting:
+        timeout = (next_bleet_time - datetime.datetime.now()).total_seconds()
+        events = dict(poller.poll(max(1, min(1000, int(timeout * 1000)))))
+
+        while consumers in events and \
+                consumers.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            identity, raw_message = router_recv(consumers)
+
+            # Heartbeats skip decoding entirely.
+            if raw_message[:1] == BLEET_FRAME:
+                if identity not in idle:
+                    slots_freed = True
+
+                idle[identity] = datetime.datetime.now()
+                router_send(consumers, identity, BLOOT_FRAME)
+
+                continue
+
+            message, _ = decode(raw_message)
+            message = FlockMessage.from_dict(message)
+
+            if message.type == "result":
+                idle.pop(identity, None)
+                awaiting_ack[message.body["id"]] = identity
+
+                # Any shepherd will take a result, but only the one that sent
+                # the request will know it's finished.
+                address = origins.pop(message.body["id"], None)
+                if address not in shepherds:
+                    address = next(iter(shepherds))
+
+                exithelpers.send_message(shepherds[address], message.to_dict())
+            elif message.type == "result_chunk":
+                # Pieces of a result go ahead of it to the same shepherd.
+                address = origins.get(message.body["id"])
+                if address not in shepherds:
+                    address = next(iter(shepherds))
+
+                exithelpers.send_message(shepherds[address], message.to_dict())
+            else:
+                logger.warning(
+                    "Unexpected message from consumer: %s", str(message)
+                )
+
+        for address, shepherd in shepherds.items():
+            while shepherd in events and \
+                    shepherd.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                raw_message = shepherd.recv()
+                if raw_message[:1] == BLOOT_FRAME:
+                    blooted.add(address)
+                    universal.note_queue_depth(
+                        address, parse_bloot_frame(raw_message)
+                    )
+
+                    continue
+
+                message, _ = decode(raw_message)
+                message = FlockMessage.from_dict(message)
+
+                if message.type == "bloot":
+                    blooted.add(address)
+
+                    if message.body in awaiting_ack:
+                        slots_freed = True
+
+                        router_send_message(
+                            consumers,
+                            awaiting_ack.pop(message.body),
+                            message.to_dict(),
+                            config["WIRE_FORMAT"]
+                        )
+                elif message.type == "identify":
+                    logger.info(
+                        "Received request to identify from shepherd at %s. "
+                        "Sending environment.",
+                        address
+                    )
+
+                    blooted.add(address)
+
+                    environment = dict(universal.environment)
+                    environment["galah/slots"] = nslots
+
+                    exithelpers.send_message(
+                        shepherd,
+                        FlockMessage("environment", environment).to_dict()
+                    )
+                elif message.type == "request":
+                    origins[str(message.body["submission"]["id"])] = address
+                    pending.append(message)
+
+        # Forget about any consumers that have stopped bleeting, they've died
+        # or moved on.
+        stale_time = datetime.datetime.now() - config["shepherd/BLEET_TIMEOUT"]
+        for identity, last_bleet in idle.items():
+            if last_bleet < stale_time:
+                del idle[identity]
+
+        # Hand requests out to the consumers that have been waiting longest.
+        while pending and idle:
+            identity, _ = idle.popitem(last = False)
+            router_send_message(
+                consumers,
+                identity,
+                pending.popleft().to_dict(),
+                config["WIRE_FORMAT"]
+            )
+
+        if datetime.datetime.now() >= next_bleet_time:
+            for address in shepherds.keys():
+                if address not in blooted:
+                    logger.warning(
+                        "Lost shepherd at %s, reconnecting.", address
+                    )
+
+                    poller.unregister(shepherds[address])
+                    shepherds[address].close()
+                    shepherds[address] = _connect_to_shepherd(address)
+                    poller.register(shepherds[address], zmq.POLLIN)
+
+            next_bleet_time = \
+                datetime.datetime.now() + config["shepherd/BLEET_TIMEOUT"] / 2
+            blooted = set()
+
+            bleet = True
+        else:
+            # Don't leave freed up consumers waiting for the next bleet.
+            bleet = slots_freed
+
+        if bleet:
+            # Each shepherd is only told about its share of our free slots. A
+            # request already on its way when we bleet may still find every
+            # consumer busy, in which case it waits in pending for the next
+            # one to free up.
+            free_slots = max(0, len(idle) - len(pending))
+            shares = _split_slots(free_slots, sorted(shepherds), bleets_sent)
+
+            for address, shepherd in shepherds.items():
+                shepherd.send(bleet_frame(shares[address]))
+
+            bleets_sent += 1
+            slots_freed = False
+
+    raise universal.Exiting()
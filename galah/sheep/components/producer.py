@@ -2,6 +2,7 @@ import logging
 import galah.sheep.utility.universal as universal
 from galah.sheep.utility.suitehelpers import get_virtual_suite
 import Queue
+import threading
 import utility
 import time
 
@@ -16,7 +17,7 @@ def run():
     
     """
     
-    logger = logging.getLogger("galah.sheep.producer")
+    logger = logging.getLogger("galah.sheep.%s" % threading.currentThread().name)
     
 	# Initialize the correct producer based on the selected virtual suite.
     virtual_suite = get_virtual_suite(config["VIRTUAL_SUITE"])
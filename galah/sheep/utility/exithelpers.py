@@ -1,5 +1,9 @@
 import universal, Queue, time, zmq, copy, time
-from zmq.utils import jsonapi
+from galah.base.zmqhelpers import encode, decode
+
+# Load Galah's configuration.
+from galah.base.config import load_config
+config = load_config("sheep")
 
 class Timeout(Exception):
     def __init__(self, *args, **kwargs):
@@ -31,11 +35,21 @@ def dequeue(queue, poll_timeout = 5):
 
     raise universal.Exiting()
 
-def recv_json(socket, timeout = None, ignore_exiting = False):
+def send_message(socket, message):
+    """
+    Sends a message over a socket in the configured wire format (see
+    sheep/WIRE_FORMAT).
+
+    """
+
+    socket.send(encode(message, config["WIRE_FORMAT"]))
+
+def recv_raw(socket, timeout = None, ignore_exiting = False):
     """
-    Receives JSON from a socket. Assumes socket is set to timeout properly.
-    Raises universal.Exiting if program is exiting, or zmq.ZMQError if
-    timed out.
+    Receives a message from a socket without decoding it, returning the list
+    of frames it's made of. Useful for checking for control frames (see
+    galah.base.zmqhelpers) before bothering to decode anything. Raises
+    universal.Exiting if program is exiting, or Timeout if timed out.
 
     timeout is in milliseconds
 
@@ -50,20 +64,32 @@ def recv_json(socket, timeout = None, ignore_exiting = False):
     poll_wait_time = 1000 if timeout is None else min(timeout, 1000)
     while ignore_exiting or not universal.exiting:
         if poller.poll(poll_wait_time):
-            msg = socket.recv_multipart()
-
-            # Decode the json in the innermost frame
-            msg[-1] = jsonapi.loads(msg[-1])
-
-            # If only one frame was received simply return that frame
-            if len(msg) == 1: msg = msg[0]
-
-            return msg
+            return socket.recv_multipart()
         elif timeout is not None and start_time + timeout <= time.time() * 1000:
             raise Timeout()
 
     raise universal.Exiting()
 
+def recv_message(socket, timeout = None, ignore_exiting = False):
+    """
+    Receives a message in any wire format from a socket. Assumes socket is set
+    to timeout properly. Raises universal.Exiting if program is exiting, or
+    Timeout if timed out.
+
+    timeout is in milliseconds
+
+    """
+
+    msg = recv_raw(socket, timeout, ignore_exiting)
+
+    # Decode the message in the innermost frame
+    msg[-1], _ = decode(msg[-1])
+
+    # If only one frame was received simply return that frame
+    if len(msg) == 1: msg = msg[0]
+
+    return msg
+
 def wait_for_queue(queue, poll_timeout = 5):
     """
     Blocks until a queue is not full or universal.exiting is True. Returns
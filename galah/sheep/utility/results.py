@@ -0,0 +1,53 @@
+"""
+Helpers for getting test results back to the shepherd no matter how much a
+test harness had to say.
+
+Each test's message is cut down to a reasonable size, with a marker noting how
+much was cut, so the result itself always fits comfortably in one message (and
+in one database document). Everything that was cut is collected into an
+overflow document that is sent to the shepherd separately in chunks (see the
+"result_chunk" message) and stored alongside the result.
+
+"""
+
+import json
+
+TRUNCATION_MARKER = u"\n[Output truncated, %d more characters.]"
+
+def split_overflow(result, max_message_size):
+    """
+    Truncates any test messages in the result longer than max_message_size
+    characters. Returns a tuple of the result and the overflow document (a
+    JSON string mapping the index of every truncated test to its full
+    message), or None if nothing was truncated.
+
+    """
+
+    overflow = {}
+
+    tests = result.get("tests")
+    if not isinstance(tests, list):
+        return (result, None)
+
+    for index, test in enumerate(tests):
+        if not isinstance(test, dict):
+            continue
+
+        message = test.get("message")
+        if not isinstance(message, basestring) or \
+                len(message) <= max_message_size:
+            continue
+
+        overflow[str(index)] = message
+        test["message"] = message[:max_message_size] + \
+            TRUNCATION_MARKER % (len(message) - max_message_size)
+
+    if not overflow:
+        return (result, None)
+
+    return (result, json.dumps({"tests": overflow}, separators = (",", ":")))
+
+def chunk(data, chunk_size):
+    """Splits a string into a list of pieces at most chunk_size long."""
+
+    return [data[i:i + chunk_size] for i in xrange(0, len(data), chunk_size)]
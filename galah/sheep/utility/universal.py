@@ -1,5 +1,9 @@
 import signal, sys, logging, threading, platform
 
+# Load Galah's configuration.
+from galah.base.config import load_config
+config = load_config("sheep")
+
 # Will be set to True when the program is exiting.
 exiting = False
 
@@ -18,6 +22,53 @@ orphaned_results = None
 # The application-wide ZMQ context used to create sockets
 context = None
 
+# The address consumers connect to when they are sharing a single connection
+# to the shepherd through the multiplexer.
+MULTIPLEXER_ADDRESS = "inproc://galah-multiplexer"
+
+def shepherd_addresses():
+    """
+    Returns a list of the addresses of every shepherd's sheep socket. There is
+    only one unless several shepherds are configured (see shepherd/SHARDS).
+
+    """
+
+    shards = config["shepherd/SHARDS"]
+    if not shards:
+        return [config["shepherd/SHEEP_SOCKET"]]
+
+    return [i["SHEEP_SOCKET"] for i in shards]
+
+def multiplexing():
+    """
+    Returns True if consumers speak to the shepherds through the multiplexer.
+    They always do when there are several shepherds, since the multiplexer is
+    what connects to every one of them.
+
+    """
+
+    return config["MULTIPLEX_CONSUMERS"] or len(shepherd_addresses()) > 1
+
+# Maps the address of every shepherd we've heard from to the number of test
+# requests waiting in its queue, as of its last bloot. Used to decide how many
+# virtual machines to keep ready.
+shepherd_queue_depths = {}
+
+def note_queue_depth(address, queue_depth):
+    """Records the queue depth a shepherd sent along with a bloot."""
+
+    if isinstance(queue_depth, (int, long)):
+        shepherd_queue_depths[address] = queue_depth
+
+def shepherd_queue_depth():
+    """
+    Returns the total number of test requests waiting in the queues of every
+    shepherd we've heard from.
+
+    """
+
+    return sum(shepherd_queue_depths.values())
+
 # The command line options the user passes in
 cmdOptions = None
 
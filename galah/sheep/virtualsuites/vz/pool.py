@@ -0,0 +1,159 @@
+"""
+Decides how many clean virtual machines the producer should keep ready.
+
+Rather than always filling the pool up to MAX_MACHINES, the pool is grown
+toward a target based on how quickly machines are being used up and how long
+it takes to make a new one, and shrunk back down when machines sit around
+unused so they aren't holding on to the host's memory off-peak.
+
+"""
+
+from collections import deque
+import threading
+import math
+import time
+
+class PoolController:
+    """
+    Keeps track of how the pool of clean virtual machines is being used and
+    computes the number of machines worth keeping ready.
+
+    The target is the number of machines that will be taken out of the pool
+    in the time it takes to make a new one (Little's law), padded by headroom.
+    Machines are taken at the rate observed over the last rate_window seconds,
+    unless the shepherd has test requests waiting, in which case every
+    consumer will take a new machine as soon as it finishes its current test,
+    so machines are taken at least at a rate of nconsumers per service time.
+
+    The target is kept between min_machines and max_machines (a max_machines
+    of 0 means no limit). A single machine is destroyed only after the pool has
+    held more than the target for shrink_delay seconds.
+
+    """
+
+    # Weight given to each new observation in the moving averages of how long
+    # machines take to make and to run tests in.
+    SMOOTHING = 0.2
+
+    def __init__(self, nconsumers, min_machines, max_machines, rate_window,
+            headroom, shrink_delay, clock = time.time):
+        self.nconsumers = nconsumers
+        self.min_machines = min_machines
+        self.max_machines = max_machines
+        self.rate_window = rate_window
+        self.headroom = headroom
+        self.shrink_delay = shrink_delay
+        self.clock = clock
+
+        # Reentrant because target() and should_shrink() use demand_rate()
+        # while holding it.
+        self._lock = threading.RLock()
+
+        # The times machines were taken from the pool, oldest first, going
+        # back rate_window seconds.
+        self._taken = deque()
+
+        # Moving averages, in seconds, or None until something is observed.
+        self.provision_time = None
+        self.service_time = None
+
+        # The time since which the pool has held more than the target, or None
+        # if it doesn't right now.
+        self._surplus_since = None
+
+    def _average(self, current, observation):
+        if current is None:
+            return observation
+
+        return (1 - self.SMOOTHING) * current + self.SMOOTHING * observation
+
+    def machine_taken(self):
+        """Should be called whenever a machine is taken from the pool."""
+
+        with self._lock:
+            self._taken.append(self.clock())
+
+    def machine_produced(self, duration):
+        """
+        Should be called whenever a machine is added to the pool, with the
+        number of seconds it took to make.
+
+        """
+
+        with self._lock:
+            self.provision_time = self._average(self.provision_time, duration)
+
+    def test_finished(self, duration):
+        """
+        Should be called whenever a test finishes, with the number of seconds
+        it took.
+
+        """
+
+        with self._lock:
+            self.service_time = self._average(self.service_time, duration)
+
+    def demand_rate(self, queue_depth):
+        """
+        Returns the rate, in machines per second, at which machines are
+        expected to be taken from the pool, given the number of test requests
+        waiting in the shepherd's queue.
+
+        """
+
+        with self._lock:
+            window_start = self.clock() - self.rate_window
+            while self._taken and self._taken[0] < window_start:
+                self._taken.popleft()
+
+            rate = len(self._taken) / float(self.rate_window)
+
+            if queue_depth and self.service_time:
+                rate = max(rate, self.nconsumers / float(self.service_time))
+
+            return rate
+
+    def target(self, queue_depth):
+        """Returns the number of machines the pool should hold."""
+
+        with self._lock:
+            # Until the first machine is made there's nothing to go on, so
+            # assume making one takes a while.
+            provision_time = self.provision_time
+            if provision_time is None:
+                provision_time = 30.0
+
+            target = int(math.ceil(
+                self.demand_rate(queue_depth) * provision_time * self.headroom
+            ))
+
+            target = max(target, self.min_machines)
+            if self.max_machines:
+                target = min(target, self.max_machines)
+
+            return target
+
+    def should_shrink(self, pool_size, queue_depth):
+        """
+        Returns True if a machine should be destroyed to bring the pool, which
+        currently holds pool_size machines, down toward the target.
+
+        """
+
+        with self._lock:
+            now = self.clock()
+
+            if pool_size <= self.target(queue_depth):
+                self._surplus_since = None
+                return False
+
+            if self._surplus_since is None:
+                self._surplus_since = now
+                return False
+
+            if now - self._surplus_since < self.shrink_delay:
+                return False
+
+            # Give the pool another shrink_delay before shrinking it again.
+            self._surplus_since = now
+            return True
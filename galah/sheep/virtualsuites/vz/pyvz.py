@@ -1,4 +1,5 @@
-import subprocess, ConfigParser, sys, os, datetime
+import subprocess, ConfigParser, sys, os, datetime, uuid, threading
+import socket, struct, tarfile, time, heapq
 from galah.base.magic import memoize
 
 # Load Galah's configuration.
@@ -99,14 +100,115 @@ class FakeHeaderWrapper(object):
         else:
             return self.configFile.readline()
 
-def create_container(id_range = range(1, 255),
-                    subnet = "10.0.1",
+def container_ip(id, subnet):
+    """
+    Returns the IP address of the container with the given id on subnet.
+
+    subnet is either the first three octets of a /24 (ex: "10.0.1"), in which
+    case the id is used as the last octet, or a network in CIDR notation (ex:
+    "10.0.0.0/16"), in which case the id is added to the network address so
+    more than 254 containers can be given addresses. Raises a ValueError if the
+    id doesn't fit in the subnet.
+
+    """
+
+    if "/" not in subnet:
+        if not 0 < id < 255:
+            raise ValueError("CTID %d does not fit in subnet %s." % (id, subnet))
+
+        return "%s.%d" % (subnet, id)
+
+    network, prefix_length = subnet.split("/")
+    host_bits = 32 - int(prefix_length)
+
+    network = struct.unpack("!I", socket.inet_aton(network))[0]
+    network &= ~((1 << host_bits) - 1) & 0xFFFFFFFF
+
+    # The first and last addresses are the network and broadcast addresses.
+    if not 0 < id < (1 << host_bits) - 1:
+        raise ValueError("CTID %d does not fit in subnet %s." % (id, subnet))
+
+    return socket.inet_ntoa(struct.pack("!I", network + id))
+
+class CTIDAllocator(object):
+    """
+    Hands out unused container ids in the range [first, last] and takes them
+    back when their containers are destroyed. Safe to use from several threads
+    at once.
+
+    Free ids are kept in a heap that is seeded from the containers on disk the
+    first time an id is needed, so allocating and releasing ids costs
+    O(log n) rather than a scan of the container directory. The lowest free
+    id is always handed out first, so a small pool keeps reusing the same few
+    ids (and addresses) rather than cycling through the whole range.
+
+    """
+
+    def __init__(self, first, last):
+        self.first = first
+        self.last = last
+
+        self._lock = threading.Lock()
+
+        # A heap of the free ids and a set of the same ids. Both are None
+        # until seeded.
+        self._free = None
+        self._free_set = None
+
+    def _seed(self):
+        extant = set(get_containers())
+
+        # Already sorted, so already a heap.
+        self._free = \
+            [i for i in xrange(self.first, self.last + 1) if i not in extant]
+        self._free_set = set(self._free)
+
+    def allocate(self):
+        """
+        Returns an unused id. Raises a RuntimeError if every id in the range is
+        in use.
+
+        """
+
+        with self._lock:
+            if self._free is None:
+                self._seed()
+
+            if not self._free:
+                raise RuntimeError(
+                    "Could not find available VM ID in permissable range "
+                    "[%d, %d]." % (self.first, self.last)
+                )
+
+            id = heapq.heappop(self._free)
+            self._free_set.remove(id)
+
+            return id
+
+    def release(self, id):
+        """Returns an id that is no longer in use to the free list."""
+
+        with self._lock:
+            # Ids outside of our range aren't ours to hand out, and if we
+            # haven't seeded yet the id will be found free when we do.
+            if self._free is None or not self.first <= id <= self.last or \
+                    id in self._free_set:
+                return
+
+            heapq.heappush(self._free, id)
+            self._free_set.add(id)
+
+# The allocator create_container() takes ids from by default.
+allocator = CTIDAllocator(*config["CTID_RANGE"])
+
+def create_container(subnet = "10.0.1",
                     os_template = None,
-                    description = None):
+                    description = None,
+                    ctid_allocator = None):
     """
-    Calls vzctl create  to create a new OpenVZ container with an id in the
-    given range. Iff an available id could not be found a RuntimeError is
-    raised.
+    Calls vzctl create  to create a new OpenVZ container with an id from
+    ctid_allocator (or the module's allocator if None). Iff an available id
+    could not be found a RuntimeError is raised.
 
     The id of the newly created container is returned.
 
@@ -114,33 +216,33 @@ def create_container(id_range = range(1, 255),
 
     """
 
-    # Get a set of all the extant containes
-    containers = set(get_containers())
+    if ctid_allocator is None:
+        ctid_allocator = allocator
 
-    # Find an available ID
-    for i in id_range:
-        if i not in containers:
-            id = i
-            break
-    else:
-        raise RuntimeError("Could not find availableVM ID in permissable range "
-                           "[%s, %s]."
-                           % (config.getint("CreateContainer", "idmin")))
+    id = ctid_allocator.allocate()
 
-    # Holds additional parameters that will be passed to vzctl create
-    parameters = []
+    try:
+        # Holds additional parameters that will be passed to vzctl create
+        parameters = []
+
+        if subnet != None:
+            parameters += ["--ipadd", container_ip(id, subnet)]
 
-    if subnet != None:
-        parameters += ["--ipadd", subnet + "." + str(id)]
+        if os_template != None:
+            parameters += ["--ostemplate", os_template]
 
-    if os_template != None:
-        parameters += ["--ostemplate", os_template]
+        if description != None:
+            parameters += ["--description", description]
 
-    if description != None:
-        parameters += ["--description", description]
+        # Actually call vzctl to create the container
+        run_vzctl(["create", str(id)] + parameters)
+    except Exception:
+        # Unless something is actually sitting on this id, it's free again.
+        container_path = os.path.join(find_container_directory(), str(id))
+        if not os.path.exists(container_path):
+            ctid_allocator.release(id)
 
-    # Actually call vzctl to create the container
-    run_vzctl(["create", str(id)] + parameters)
+        raise
 
     return id
 
@@ -156,9 +258,14 @@ def stop_container(id):
     run_vzctl(["stop", str(id)])
 
 def destroy_container(id):
-    "Destroys a given container and raises a SystemError if it fails."
+    """
+    Destroys a given container and raises a SystemError if it fails. Its id is
+    returned to the module's allocator.
+
+    """
 
     run_vzctl(["destroy", str(id)])
+    allocator.release(id)
 
 def extirpate_container(id):
     "Destroys a container and stops it first if it must."
@@ -166,6 +273,39 @@ def extirpate_container(id):
     stop_container(id)
     destroy_container(id)
 
+# Namespace for the ids of the snapshots taken by snapshot_container(). Each
+# container's snapshot id is derived from its CTID, so it can be found again
+# without having to be stored anywhere.
+SNAPSHOT_NAMESPACE = uuid.UUID("5b8a8c1e-4f0d-4a59-9d3c-6a3f0f2b7c41")
+
+def snapshot_id(id):
+    "Returns the id of the snapshot snapshot_container() takes of a container."
+
+    return str(uuid.uuid5(SNAPSHOT_NAMESPACE, str(id)))
+
+def snapshot_container(id, name = "galah-clean"):
+    """
+    Takes a snapshot of a container that can later be returned to with
+    revert_container(). If the container is running, its memory is saved along
+    with its filesystem so that reverting leaves it running exactly as it was.
+
+    Only containers using the ploop layout can be snapshotted. Raises a
+    SystemError if the snapshot could not be taken.
+
+    """
+
+    run_vzctl(["snapshot", str(id), "--id", snapshot_id(id), "--name", name])
+
+def revert_container(id):
+    """
+    Throws away every change made to a container since snapshot_container()
+    was called on it, including any change to its configuration. Raises a
+    SystemError if it fails (for example, if the container has no snapshot).
+
+    """
+
+    run_vzctl(["snapshot-switch", str(id), "--id", snapshot_id(id)])
+
 def inject_file(id, source, to, move = False, permissions = "rwx",
                unpack = False):
     """
@@ -216,6 +356,66 @@ def inject_file(id, source, to, move = False, permissions = "rwx",
     check_call(["chmod", "-R", "a=%s" % (permissions), ztoReal],
                stdout = nullFile, stderr = nullFile)
 
+def inject_files(id, files, permissions = 0777):
+    """
+    Injects many files into the container with id id at once. files is a list
+    of (source, to) tuples with the same meaning as inject_file's arguments:
+    if source is a directory its contents are injected into to, otherwise
+    source itself is. Any directories in to that don't exist are created.
+
+    Everything is sent to a single tar process as one archive in which every
+    file is already owned by root and has the given permissions, so no matter
+    how many files there are only one process is started. Directories that
+    already exist (ex: /tmp) are left as they are.
+
+    Raises a SystemError if tar fails.
+
+    """
+
+    def as_root(info):
+        info.uid = info.gid = 0
+        info.uname = info.gname = "root"
+        info.mode = permissions
+
+        return info
+
+    p = subprocess.Popen(
+        ["tar", "-x", "-p", "--same-owner", "--no-overwrite-dir", "-C",
+            container_to_host_path(id, "/")],
+        stdin = subprocess.PIPE, stdout = nullFile, stderr = nullFile
+    )
+
+    try:
+        archive = tarfile.open(fileobj = p.stdin, mode = "w|")
+
+        for source, to in files:
+            # Paths in the archive are relative to the container's root.
+            destination = os.path.normpath(to).lstrip("/")
+
+            directory = tarfile.TarInfo(destination)
+            directory.type = tarfile.DIRTYPE
+            directory.mtime = time.time()
+            archive.addfile(as_root(directory))
+
+            if os.path.isdir(source):
+                sources = [os.path.join(source, i) for i in os.listdir(source)]
+            else:
+                sources = [source]
+
+            for i in sources:
+                archive.add(
+                    i,
+                    arcname = os.path.join(destination, os.path.basename(i)),
+                    filter = as_root
+                )
+
+        archive.close()
+    finally:
+        p.stdin.close()
+
+        if p.wait() != 0:
+            raise SystemError((p.returncode, "tar"))
+
 def run_shell_script_from_host(id, script):
     """
     Runs the given script located at script on the host system inside of the
@@ -1,6 +1,8 @@
 import galah.sheep.utility.exithelpers as exithelpers
+import galah.sheep.utility.universal as universal
 from galah.sheep.utility.testrequest import PreparedTestRequest
 import pyvz
+from pool import PoolController
 import time
 import Queue
 import socket
@@ -8,6 +10,8 @@ import os
 import os.path
 import json
 import datetime
+import tempfile
+import threading
 
 # Load Galah's configuration.
 from galah.base.config import load_config
@@ -15,10 +19,95 @@ config = load_config("sheep/vz")
 
 containers = Queue.Queue(maxsize = config["MAX_MACHINES"])
 
+# Decides how many clean containers to keep around when ADAPTIVE_POOL is on.
+pool = PoolController(
+    nconsumers = config["sheep/NCONSUMERS"],
+    min_machines = config["MIN_MACHINES"],
+    max_machines = config["MAX_MACHINES"],
+    rate_window = config["POOL_RATE_WINDOW"].total_seconds(),
+    headroom = config["POOL_HEADROOM"],
+    shrink_delay = config["POOL_SHRINK_DELAY"].total_seconds()
+)
+
+# The number of containers producers are in the middle of making, which is
+# counted along with the containers in the queue when deciding whether to make
+# another, so several producers don't all make the last one.
+in_production = 0
+in_production_lock = threading.Lock()
+
+def start_production(limit):
+    """
+    Claims the right to make a new container if fewer than limit containers
+    are either in the queue or being made (a limit of None means no limit, a
+    limit of 0 means none may be made). Returns True if successful, in which
+    case finish_production() must be called once the container is made or
+    abandoned.
+
+    """
+
+    global in_production
+
+    with in_production_lock:
+        if limit is not None and containers.qsize() + in_production >= limit:
+            return False
+
+        in_production += 1
+
+        return True
+
+def finish_production():
+    global in_production
+
+    with in_production_lock:
+        in_production -= 1
+
+def recycle_container(logger, id):
+    """
+    Rolls a used container back to the snapshot taken when it was created and
+    puts it back in the queue of clean containers. Returns True if successful.
+    Otherwise the container is left alone and should be destroyed.
+
+    """
+
+    try:
+        pyvz.revert_container(id)
+
+        # The snapshot should have restored this already, but a dirty
+        # container being handed out as clean would be a disaster.
+        pyvz.set_attribute(id, "description", "galah-vm: clean")
+    except SystemError:
+        logger.exception("Could not revert VM with CTID %d.", id)
+
+        return False
+
+    # Never wait on the queue here. The consumers putting containers back are
+    # the only ones that take them out, so waiting could wait forever.
+    try:
+        containers.put_nowait(id)
+    except Queue.Full:
+        return False
+
+    logger.debug("Reverted VM with CTID %d and added it to the queue.", id)
+
+    return True
+
 # Performs one time setup for the entire module. Cannot be a member function of
 # producer because it needs to be called once at startup, and the producer class
 # would not have been made yet.
 def setup(logger):
+    # Every id we might give a container needs an address on the subnet.
+    # container_ip() checks a contiguous range, so checking the ends of
+    # CTID_RANGE covers everything in between.
+    if config["VM_SUBNET"] is not None:
+        for i in config["CTID_RANGE"]:
+            try:
+                pyvz.container_ip(i, config["VM_SUBNET"])
+            except ValueError:
+                raise ValueError(
+                    "CTID_RANGE %s does not fit in VM_SUBNET %s." %
+                        (str(config["CTID_RANGE"]), config["VM_SUBNET"])
+                )
+
     if config["MAX_MACHINES"] == 0:
         logger.warning(
             "MAX_MACHINES is 0. Infinitely many virtual machines will be "
@@ -60,6 +149,12 @@ def setup(logger):
 
     # Get a list of all the dirty virtual machines
     dirty_machines = pyvz.get_containers("galah-vm: dirty")
+
+    # Dirty machines with a snapshot can be cleaned up much more quickly than
+    # new ones can be made.
+    if config["RECYCLE_CONTAINERS"]:
+        dirty_machines = \
+            [i for i in dirty_machines if not recycle_container(logger, i)]
     if dirty_machines:
         logger.info("Destroying dirty VMs with CTIDs %s.", str(dirty_machines))
 
@@ -74,12 +169,48 @@ class Producer:
         self.logger = logger
         self._last_low_machine_log = datetime.datetime.min
 
+    def _destroy_surplus_vm(self):
+        try:
+            id = containers.get_nowait()
+        except Queue.Empty:
+            return
+
+        self.logger.info(
+            "VM cache is above its target size, destroying VM with CTID %d.",
+            id
+        )
+
+        try:
+            pyvz.extirpate_container(id)
+        except SystemError:
+            self.logger.exception("Could not destroy VM with CTID %d.", id)
+
     def produce_vm(self):
-        if containers.full():
+        if config["ADAPTIVE_POOL"]:
+            queue_depth = universal.shepherd_queue_depth()
+
+            if not start_production(pool.target(queue_depth)):
+                if pool.should_shrink(containers.qsize(), queue_depth):
+                    self._destroy_surplus_vm()
+
+                # Check on demand again shortly.
+                time.sleep(1)
+                return None
+        elif not start_production(config["MAX_MACHINES"] or None):
             self.logger.info("MAX_MACHINES machines exist. Waiting...")
 
-            exithelpers.wait_for_queue(containers)
+            while not start_production(config["MAX_MACHINES"] or None):
+                if universal.exiting:
+                    raise universal.Exiting()
+
+                time.sleep(1)
 
+        try:
+            return self._create_vm()
+        finally:
+            finish_production()
+
+    def _create_vm(self):
         # Check to see if we are low on virtual machines.
         if (self._last_low_machine_log + config["LOW_MACHINE_PERIOD"] <
                 datetime.datetime.today() and
@@ -95,6 +226,8 @@ class Producer:
 
         self.logger.debug("Creating new VM.")
 
+        start_time = time.time()
+
         try:
             # Create new container with unique id
             id = pyvz.create_container(
@@ -102,7 +235,7 @@ class Producer:
                 description = "galah-vm: clean",
                 subnet = config["VM_SUBNET"]
             )
-        except (RuntimeError, SystemError):
+        except (RuntimeError, SystemError, ValueError):
             self.logger.exception("Error occured when creating VM")
 
             # Sleep for a bit and then try again
@@ -134,6 +267,30 @@ class Producer:
 
             return None
 
+        if config["RECYCLE_CONTAINERS"]:
+            # Once tests have been run in the container it will be rolled back
+            # to this snapshot rather than destroyed.
+            try:
+                pyvz.snapshot_container(id)
+            except SystemError:
+                self.logger.exception(
+                    "Could not snapshot VM with CTID %d. Is it using ploop?",
+                    id
+                )
+
+                try:
+                    pyvz.extirpate_container(id)
+                except SystemError:
+                    self.logger.critical(
+                        "Could not destroy unsnapshottable VM with CTID %d!!! "
+                        "Manual destruction is required." % id
+                    )
+
+                time.sleep(5)
+                return None
+
+        pool.machine_produced(time.time() - start_time)
+
         # Try to add the container to the queue until successful or the program
         # is exiting.
         exithelpers.enqueue(containers, id)
@@ -146,12 +303,65 @@ class Consumer:
     def __init__(self, logger):
         self.logger = logger
 
+    def _receive_results(self, bootstrapper, results):
+        """
+        Reads the test results from the bootstrapper into the file results and
+        decodes them. Returns None if the bootstrapper doesn't give valid
+        results.
+
+        """
+
+        try:
+            # Receive test results from the VM
+            self.logger.debug("Waiting for test results from bootstrapper.")
+            size = 0
+            while True:
+                received = bootstrapper.recv(4096)
+
+                if not received:
+                    break
+
+                size += len(received)
+                if size > config["MAX_RESULT_SIZE"]:
+                    # There's no making sense of the half of a JSON document
+                    # we'd be left with if we stopped here.
+                    self.logger.info(
+                        "Test harness gave more than %d bytes of output.",
+                        config["MAX_RESULT_SIZE"]
+                    )
+
+                    return None
+
+                results.write(received)
+
+            self.logger.debug("Test results received (%d bytes).", size)
+        except socket.timeout:
+            self.logger.debug("Bootstrapper timed out")
+
+            return None
+
+        try:
+            results.seek(0)
+            return json.load(results)
+        except ValueError:
+            results.seek(0)
+            self.logger.info(
+                "Test harness gave bad output: %s", results.read(4096)
+            )
+
+            return None
+
     def prepare_machine(self):
-        return exithelpers.dequeue(containers)
+        id = exithelpers.dequeue(containers)
+        pool.machine_taken()
+
+        return id
 
     def run_test(self, container_id, test_request):
         self.logger.debug("Running test with VM with CTID %d.", container_id)
 
+        start_time = time.time()
+
         try:
             # Mark container as dirty before we do anything at all
             pyvz.set_attribute(container_id, "description", "galah-vm: dirty")
@@ -186,30 +396,19 @@ class Consumer:
                     (testable_directory, harness_directory)
             )
 
-            if config["CALL_MKDIR"]:
-                pyvz.execute(
-                    container_id,
-                    "mkdir -p %s %s" % (
-                        config["VM_TESTABLES_DIRECTORY"],
-                        config["VM_HARNESS_DIRECTORY"]
-                    )
-                )
-
-            # Inject file into VM from the testables location
-            pyvz.inject_file(
-                container_id, testable_directory, config["VM_TESTABLES_DIRECTORY"]
-            )
-
-            # Ditto from the test harness's location
-            pyvz.inject_file(container_id, harness_directory, config["VM_HARNESS_DIRECTORY"])
+            # Inject the testables, the test harness, and the bootstrapper
+            # (which is responsible for running inside of the virtual machine
+            # with root privelages and starting up the test harness while
+            # communicating with us) all at once.
+            pyvz.inject_files(container_id, [
+                (testable_directory, config["VM_TESTABLES_DIRECTORY"]),
+                (harness_directory, config["VM_HARNESS_DIRECTORY"]),
+                (config["BOOTSTRAPPER"], "/tmp/")
+            ])
 
-            # Inject bootstrapper (which is responsible for running inside of
-            # the virtual machine with root privelages and starting up the test
-            # harness while communicating with us).
             self.logger.debug(
                 "Running bootstrapper at '%s'." % config["BOOTSTRAPPER"]
             )
-            pyvz.inject_file(container_id, config["BOOTSTRAPPER"], "/tmp/")
             pyvz.run_script(
                 container_id,
                 os.path.join("/tmp/", os.path.basename(config["BOOTSTRAPPER"]))
@@ -226,12 +425,14 @@ class Consumer:
             while time.time() <= deadline:
                 try:
                     bootstrapper.connect(
-                        ("%s.%d" % (config["VM_SUBNET"], container_id), config["VM_PORT"])
+                        (pyvz.container_ip(container_id, config["VM_SUBNET"]),
+                            config["VM_PORT"])
                     )
 
                     self.logger.debug(
-                        "Connected to %s.%d:%d.",
-                        config["VM_SUBNET"], container_id, config["VM_PORT"]
+                        "Connected to %s:%d.",
+                        pyvz.container_ip(container_id, config["VM_SUBNET"]),
+                        config["VM_PORT"]
                     )
 
                     break
@@ -264,36 +465,26 @@ class Consumer:
             bootstrapper.send(json.dumps(prepared_request))
             bootstrapper.shutdown(socket.SHUT_WR)
 
-            try:
-                # Receive test results from the VM
-                self.logger.debug("Waiting for test results from bootstrapper.")
-                results = []
-                while True:
-                    received = bootstrapper.recv(4096)
-
-                    if not received:
-                        break
-
-                    results.append(received)
-                results = "".join(results)
-
-                self.logger.debug("Test results received %s.", results)
-            except socket.timeout:
-                self.logger.debug("Bootstrapper timed out")
-
-                return None
+            # Results are kept in memory unless they get big, in which case
+            # they're moved to disk.
+            results = tempfile.SpooledTemporaryFile(
+                max_size = config["RESULT_SPOOL_SIZE"]
+            )
 
             try:
-                return json.loads(results)
-            except ValueError:
-                self.logger.info("Test harness gave bad output: %s", results)
-                return None
+                return self._receive_results(bootstrapper, results)
+            finally:
+                results.close()
         finally:
-            self.logger.debug("Destroying VM with CTID %d" % container_id)
+            pool.test_finished(time.time() - start_time)
 
-            try:
-                pyvz.extirpate_container(container_id)
-            except SystemError:
-                self.logger.critical(
-                    "Could not destroy container with container_id %s.", str(container_id)
-                )
+            if not (config["RECYCLE_CONTAINERS"] and
+                    recycle_container(self.logger, container_id)):
+                self.logger.debug("Destroying VM with CTID %d" % container_id)
+
+                try:
+                    pyvz.extirpate_container(container_id)
+                except SystemError:
+                    self.logger.critical(
+                        "Could not destroy container with container_id %s.", str(container_id)
+                    )
@@ -1,16 +1,161 @@
+from galah.base.hashring import HashRing
+import datetime
 import zmq
 
+# Load Galah's configuration.
+from galah.base.config import load_config
+config = load_config("shepherd")
+
 context = zmq.Context()
 context.linger = 2 * 1000
 
-def send_test_request(shepherd_host, submission_id):
+# When running several shepherds, maps each shard's name to its entry in
+# SHARDS and places the shards on a ring to divide the assignments up.
+_shards = dict((i["NAME"], i) for i in config["SHARDS"] or [])
+_ring = HashRing(_shards.keys())
+
+# Maps shard names to (alive, time checked) tuples so we don't have to ask a
+# shard whether it's alive before every request.
+_liveness = {}
+
+# Maps shepherd addresses to (status, time checked) tuples. See
+# get_cached_queue_status().
+_queue_statuses = {}
+
+def _query(shepherd_host, query, timeout):
+    """
+    Sends a query to the shepherd and returns its answer, or None if the
+    shepherd didn't answer within timeout milliseconds.
+
+    """
+
+    shepherd = context.socket(zmq.DEALER)
+    shepherd.connect(shepherd_host)
+
+    try:
+        shepherd.send_json({"query": query})
+
+        poller = zmq.Poller()
+        poller.register(shepherd, zmq.POLLIN)
+        if poller.poll(timeout):
+            return shepherd.recv_json()
+
+        return None
+    finally:
+        shepherd.close(0)
+
+def get_queue_status(shepherd_host, timeout = 1000):
+    """
+    Asks the shepherd how backed up it is. Returns a dictionary with (at
+    least) the keys queue_depth (the number of test requests waiting) and
+    estimated_wait (roughly how many seconds a new request will wait, or None
+    if the shepherd can't tell yet). Returns None if the shepherd didn't
+    answer within timeout milliseconds.
+
+    """
+
+    return _query(shepherd_host, "status", timeout)
+
+def get_dead_letters(shepherd_host, timeout = 1000):
+    """
+    Asks the shepherd which test requests it gave up on after their sheep
+    kept dying. Returns a list of dictionaries with the keys submission_id,
+    harness_id, and time (when the request was given up on, in ISO 8601
+    format), oldest first. Returns None if the shepherd didn't answer within
+    timeout milliseconds.
+
+    """
+
+    return _query(shepherd_host, "dead_letters", timeout)
+
+def get_cached_queue_status(shepherd_host):
+    """
+    Like get_queue_status(), but meant for places that can't afford to wait
+    on the shepherd (like serving a web request). The shepherd is given only
+    QUEUE_STATUS_TIMEOUT to answer, and its answer (or lack of one) is reused
+    for QUEUE_STATUS_TTL.
+
+    """
+
+    status, checked = _queue_statuses.get(shepherd_host, (None, None))
+    if checked is not None and \
+            datetime.datetime.now() - checked < config["QUEUE_STATUS_TTL"]:
+        return status
+
+    timeout = config["QUEUE_STATUS_TIMEOUT"].total_seconds() * 1000
+    status = get_queue_status(shepherd_host, max(1, int(timeout)))
+
+    _queue_statuses[shepherd_host] = (status, datetime.datetime.now())
+
+    return status
+
+def _is_alive(name):
+    alive, checked = _liveness.get(name, (None, None))
+    if checked is not None and \
+            datetime.datetime.now() - checked < config["SHARD_LIVENESS_TTL"]:
+        return alive
+
+    timeout = config["SHARD_PROBE_TIMEOUT"].total_seconds() * 1000
+    status = get_queue_status(_shards[name]["PUBLIC_SOCKET"], int(timeout))
+    alive = status is not None
+
+    # The answer is as good as any for get_cached_queue_status() as well.
+    now = datetime.datetime.now()
+    _liveness[name] = (alive, now)
+    _queue_statuses[_shards[name]["PUBLIC_SOCKET"]] = (status, now)
+
+    return alive
+
+def find_shepherd(assignment_id, default_host = None):
+    """
+    Returns the address of the public socket of the shepherd that test
+    requests for submissions to the given assignment should be sent to.
+
+    If SHARDS isn't configured (or assignment_id is None) there's only one
+    shepherd to choose from, default_host (or PUBLIC_SOCKET if that's None).
+    Otherwise the shard owning the assignment is returned, unless it isn't
+    answering, in which case the next live shard around the ring takes over
+    until it's back.
+
+    """
+
+    if not _shards or assignment_id is None:
+        return default_host or config["PUBLIC_SOCKET"]
+
+    owner = None
+    for name in _ring.iter_nodes(str(assignment_id)):
+        if owner is None:
+            owner = name
+
+        if _is_alive(name):
+            return _shards[name]["PUBLIC_SOCKET"]
+
+    # Nobody is answering. The owner is as good a choice as any.
+    return _shards[owner]["PUBLIC_SOCKET"]
+
+def send_test_request(shepherd_host, submission_id, rerun = False,
+        assignment_id = None):
+    """
+    Asks the shepherd to test the given submission. Reruns are dispatched
+    after any interactive requests that have been waiting a similar amount of
+    time.
+
+    If assignment_id is given and SHARDS is configured, the request is sent to
+    the shepherd that owns the assignment (see find_shepherd()) rather than
+    shepherd_host.
+
+    """
+
+    shepherd_host = find_shepherd(assignment_id, shepherd_host)
+
     # TODO: Make the socket thread-local.
     # Create a new socket to send a test request to shepherd.
     shepherd = context.socket(zmq.DEALER)
 
     shepherd.connect(shepherd_host)
     shepherd.send_json({
-       "submission_id": str(submission_id)
+       "submission_id": str(submission_id),
+       "rerun": rerun
     })
 
     shepherd.close()
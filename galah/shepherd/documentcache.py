@@ -0,0 +1,83 @@
+from collections import OrderedDict
+import datetime
+
+class DocumentCache:
+    """
+    A bounded least-recently-used cache whose entries expire after a fixed
+    amount of time. Used by the shepherd to avoid fetching the same
+    assignments, test harnesses, and users for every submission.
+
+    Nothing in the database tells us when a document was last modified, so the
+    time-to-live is the only means of invalidation. Keep it short.
+
+    """
+
+    def __init__(self, max_size, ttl):
+        # The maximum number of entries that will be held at once.
+        self.max_size = max_size
+
+        # A timedelta, how long an entry is considered fresh.
+        self.ttl = ttl
+
+        # Maps keys to (expiration time, value) tuples. The least recently
+        # used entry is always first.
+        self._entries = OrderedDict()
+
+        # Counters that can be inspected to see how effective the cache is.
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default = None):
+        """
+        Returns the value cached under key if it exists and hasn't expired,
+        otherwise default is returned.
+
+        """
+
+        entry = self._entries.pop(key, None)
+
+        if entry is None or entry[0] < datetime.datetime.now():
+            self.misses += 1
+
+            return default
+
+        # Move the entry to the end since it was just used.
+        self._entries[key] = entry
+        self.hits += 1
+
+        return entry[1]
+
+    def peek(self, key, default = None):
+        """
+        Like get(), but neither counts as a hit or miss nor marks the entry as
+        recently used. For checks that shouldn't affect the cache's
+        statistics.
+
+        """
+
+        entry = self._entries.get(key)
+
+        if entry is None or entry[0] < datetime.datetime.now():
+            return default
+
+        return entry[1]
+
+    def put(self, key, value):
+        """Caches value under key, evicting the oldest entry if needed."""
+
+        self._entries.pop(key, None)
+        self._entries[key] = (datetime.datetime.now() + self.ttl, value)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last = False)
+
+    def invalidate(self, key):
+        """Removes the entry cached under key if there is one."""
+
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
@@ -0,0 +1,121 @@
+"""
+Helpers for matching test requests against sheep by environment without
+walking the entire flock or the entire backlog.
+
+A sheep advertises an environment (a dict) and a test request requires an
+environment (also a dict). A request may be serviced by a sheep iff the
+request's environment is a subset of the sheep's environment (see
+FlockManager.check_environments()). Because environments come from a small
+number of test harness configurations and a small number of sheep hosts, we
+bucket members by their entire environment and only ever compare buckets.
+
+Each bucket is an IndexedPriorityDict so the member with the lowest priority
+(ex: the request that has been waiting the longest) can be found without
+scanning the bucket.
+
+"""
+
+from galah.base.prioritydict import IndexedPriorityDict
+
+def _freeze(value):
+    """
+    Transforms a JSON-like value into an equivalent hashable value. Dicts
+    become sorted tuples of pairs and lists become tuples.
+
+    """
+
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    elif isinstance(value, (list, tuple)):
+        return ("__list__", ) + tuple(_freeze(i) for i in value)
+    else:
+        return value
+
+def normalize_environment(environment):
+    """
+    Returns a frozenset of the normalized key-value pairs of the given
+    environment. Two environments match (in the sense of
+    FlockManager.check_environments()) iff the normalized form of one is a
+    subset of the normalized form of the other.
+
+    """
+
+    return frozenset((k, _freeze(v)) for k, v in environment.items())
+
+class EnvironmentIndex:
+    """
+    Groups members (sheep identities or test requests) into buckets keyed by
+    their normalized environment.
+
+    """
+
+    def __init__(self):
+        # Maps normalized environments to an IndexedPriorityDict of the members
+        # with that environment.
+        self._buckets = {}
+
+        # Maps members to their normalized environments so that they can be
+        # removed without knowing their environment.
+        self._members = {}
+
+    def __contains__(self, member):
+        return member in self._members
+
+    def __len__(self):
+        return len(self._members)
+
+    def add(self, member, environment, priority = None):
+        """
+        Adds a member to the index with the given priority. Re-adding a member
+        moves it.
+
+        """
+
+        key = normalize_environment(environment)
+
+        if member in self._members:
+            self.discard(member)
+
+        self._members[member] = key
+        self._buckets.setdefault(key, IndexedPriorityDict())[member] = priority
+
+    def discard(self, member):
+        """Removes a member from the index if it is in there."""
+
+        key = self._members.pop(member, None)
+        if key is None:
+            return
+
+        bucket = self._buckets[key]
+        del bucket[member]
+
+        # Don't let empty buckets pile up, they'd have to be checked on every
+        # lookup.
+        if not bucket:
+            del self._buckets[key]
+
+    def buckets_within(self, environment):
+        """
+        Yields every bucket whose environment is a subset of the given
+        environment. Use this to find the requests a sheep can service.
+
+        """
+
+        key = normalize_environment(environment)
+
+        for bucket_key, bucket in self._buckets.items():
+            if bucket_key <= key:
+                yield bucket
+
+    def buckets_covering(self, environment):
+        """
+        Yields every bucket whose environment is a superset of the given
+        environment. Use this to find the sheep that can service a request.
+
+        """
+
+        key = normalize_environment(environment)
+
+        for bucket_key, bucket in self._buckets.items():
+            if key <= bucket_key:
+                yield bucket
@@ -1,6 +1,9 @@
 from galah.base.prioritydict import PriorityDict
-from collections import namedtuple
+from galah.base.timerwheel import HeapTimeouts, TimerWheel, monotonic
+from collections import namedtuple, deque
 from galah.base.flockmail import InternalTestRequest
+from galah.shepherd.environments import EnvironmentIndex
+from galah.shepherd import metrics
 import datetime
 
 # Load Galah's configuration.
@@ -10,43 +13,163 @@ config = load_config("shepherd")
 import heapq
 class FlockManager:
 	class SheepInfo:
-		__slots__ = ("environment", "servicing_request")
+		__slots__ = ("environment", "slots", "counts_slots", "ready",
+			"servicing_requests")
 
-		def __init__(self, environment, servicing_request):
+		def __init__(self, environment, slots = 1, counts_slots = True):
 			self.environment = environment
-			self.servicing_request = servicing_request
 
-	def __init__(self, match_found, bleet_timeout, service_timeout):
+			# The number of requests the sheep can service at once.
+			self.slots = slots
+
+			# False for older sheep that don't say how many slots they have
+			# (and so have exactly one). Such sheep only bleet when they're
+			# idle, while sheep that count their slots keep bleeting while
+			# they're busy and must be answered.
+			self.counts_slots = counts_slots
+
+			# The number of requests the sheep last told us it was ready for,
+			# less any we've sent it since. None if the sheep doesn't tell us
+			# (in which case only slots is used).
+			self.ready = None
+
+			# The set of requests the sheep is currently servicing.
+			self.servicing_requests = set()
+
+		def free_slots(self):
+			return self.slots - len(self.servicing_requests)
+
+		def is_available(self):
+			"""
+			Returns True if the sheep can be sent another request right now.
+
+			"""
+
+			return (self.free_slots() > 0 and
+				(self.ready is None or self.ready > 0))
+
+	def __init__(self, match_found, bleet_timeout, service_timeout,
+			deadline_horizon = None, deadline_weight = 0, max_retries = 0,
+			retry_backoff = None, dead_letter_limit = 1000,
+			service_grace = None, journal = None, class_delays = None,
+			timeout_tracker = "heap", wheel_resolution = None):
 		# The flock of sheep we are managing. Dictionary mapping sheep
 		# identities to information on that sheep (specifically SheepInfo
 		# instances).
 		self._flock = {}
 
-		# A priority queue where sheep are ordered by the time when they last
-		# bleeted. The top of/smallest item in the priority queue is the sheep
-		# who has bleeted the farthest amount of time ago.
-		self._bleet_queue = PriorityDict()
+		# Maps every sheep to the time at which it will be assumed lost if it
+		# doesn't bleet again. Sheep with no free slots are not in here, the
+		# service queue keeps track of them.
+		#
+		# This and the service queue are updated constantly, so they are
+		# timeout trackers (see galah.base.timerwheel) rather than
+		# PriorityDicts. timeout_tracker picks which: "heap" for exact
+		# timeouts or "wheel" for cheaper but coarser ones. Times are in
+		# seconds as given by monotonic().
+		self._bleet_queue = self._make_timeout_tracker(
+			timeout_tracker, wheel_resolution
+		)
 
-		# A priority queue that keeps track of how long each sheep has been
-		# working on their current request. Same idea as the bleet queue.
-		self._service_queue = PriorityDict()
+		# Maps (sheep identity, request) pairs for every request being
+		# serviced to the time at which the sheep will be assumed dead if it
+		# hasn't returned a result.
+		self._service_queue = self._make_timeout_tracker(
+			timeout_tracker, wheel_resolution
+		)
 
 		# A priority queue that keeps track of how long each request has been
 		# waiting for a match. Same idea as the bleet queue.
 		self._request_queue = PriorityDict()
 
+		# Maps every request being serviced to a (sheep identity, start time)
+		# tuple.
+		self._assigned_requests = {}
+
+		# Maps the id (as a string) of every submission with a pending request
+		# (see is_request_pending()) to a list of those requests, so
+		# duplicates can be spotted before anything about the request is
+		# loaded.
+		self._pending_submissions = {}
+
+		# Maps every pending request to the time it first arrived, which
+		# it keeps if it has to be retried so it doesn't lose its place.
+		self._arrival_times = {}
+
+		# The total number of slots across the flock.
+		self._total_slots = 0
+
+		# An exponentially weighted moving average of how many seconds it takes
+		# a sheep to service a request, or None if no request has finished yet.
+		self.average_service_time = None
+		self.service_time_smoothing = 0.1
+
+		# Indexes of the available sheep (the sheep in the bleet queue that can
+		# be sent a request) and the waiting requests (the requests in the
+		# request queue) bucketed by environment. These let us find a match
+		# without checking every sheep or every request.
+		self._idle_index = EnvironmentIndex()
+		self._request_index = EnvironmentIndex()
+
 		# The amount of time a sheep can go without bleeting before it is
 		# assumed to be lost.
 		self.bleet_timeout = bleet_timeout
 
 		# The amount of time that a sheep may spend servicing a request before
-		# it is assumed to be dead.
+		# it is assumed to be dead. Only used for requests that don't carry
+		# their own timeout.
 		self.service_timeout = service_timeout
 
+		# Extra time given to a sheep on top of the request's timeout to
+		# account for setting up the test and sending back the result.
+		self.service_grace = service_grace
+
 		# A function that's called whenever a sheep is paired with a particular
 		# test request.
 		self.match_found = match_found
 
+		# Requests for assignments due within deadline_horizon are dispatched
+		# as if they arrived earlier. A request due right now is treated as if
+		# it arrived deadline_weight * deadline_horizon earlier. A weight of 0
+		# gives plain first-come first-served ordering.
+		self.deadline_horizon = deadline_horizon
+		self.deadline_weight = deadline_weight
+
+		# Maps request priority classes to how long a request of that class is
+		# held back in favor of requests of other classes. A request is never
+		# held back longer than its class's delay, so lower classes can't be
+		# starved.
+		self.class_delays = class_delays or {}
+
+		# A priority queue of requests whose sheep died while servicing them,
+		# ordered by when they may be placed back into the request queue.
+		self._deferred_requests = PriorityDict()
+
+		# The number of times a request may be retried after its sheep dies
+		# before we give up on it, and how long to wait before the first
+		# retry. The wait doubles with every subsequent retry.
+		self.max_retries = max_retries
+		self.retry_backoff = retry_backoff
+
+		# The requests we have given up on, as (request, time) tuples, oldest
+		# first. Only the most recent dead_letter_limit are kept.
+		self.dead_letters = deque(maxlen = dead_letter_limit)
+
+		# If not None, a RequestJournal that is told about every request we
+		# accept and every request we are done with.
+		self.journal = journal
+
+	@staticmethod
+	def _make_timeout_tracker(kind, wheel_resolution):
+		if kind == "heap":
+			return HeapTimeouts()
+		elif kind == "wheel":
+			return TimerWheel(
+				wheel_resolution.total_seconds() if wheel_resolution else 1
+			)
+		else:
+			raise ValueError("Unknown timeout tracker %s." % repr(kind))
+
 	def _dispatch_match_found(self, sheep_identity, request):
 		if self.match_found(self, sheep_identity, request):
 			self.assign_sheep(sheep_identity, request)
@@ -55,37 +178,184 @@ class FlockManager:
 
 		return False
 
+	def _request_priority(self, request, arrival_time):
+		"""
+		Returns the priority a request should be dispatched with. Smaller
+		priorities are dispatched first.
+
+		"""
+
+		priority = arrival_time + self.class_delays.get(
+			request.priority_class, datetime.timedelta(0)
+		)
+
+		if (not self.deadline_weight or not self.deadline_horizon or
+				request.deadline is None):
+			return priority
+
+		# How long before the deadline the request arrived. Requests arriving
+		# after the deadline get the full boost.
+		remaining = max(request.deadline - arrival_time, datetime.timedelta(0))
+		if remaining >= self.deadline_horizon:
+			return priority
+
+		boost = (self.deadline_horizon - remaining).total_seconds()
+		return priority - \
+			datetime.timedelta(seconds = boost * self.deadline_weight)
+
 	def _sheep_available(self, identity):
 		"""Called internally whenever a new sheep becomes available."""
 
-		sheep_environment = self._flock[identity]
+		sheep_environment = self._flock[identity].environment
 
-		for i in self._request_queue.keys()[:]:
-			if FlockManager.check_environments(i.environment, \
-					sheep_environment):
-				if self._dispatch_match_found(identity, i):
+		self._idle_index.add(
+			identity, sheep_environment, self._bleet_queue[identity]
+		)
+
+		# Keep handing the sheep requests until it's full or there's nothing it
+		# can service.
+		while identity in self._idle_index:
+			# Only the head of each compatible bucket needs to be considered.
+			# We try them oldest first so requests are serviced in arrival
+			# order.
+			candidates = [i.smallest() for i in
+				self._request_index.buckets_within(sheep_environment)]
+			candidates.sort(key = lambda i: i.priority)
+
+			for i in candidates:
+				if self._dispatch_match_found(identity, i.value):
 					break
+			else:
+				return
+
+	def _track_pending(self, request, arrival_time):
+		self._pending_submissions.setdefault(
+			str(request.submission_id), []
+		).append(request)
+		self._arrival_times[request] = arrival_time
+
+	def _untrack_pending(self, request):
+		del self._arrival_times[request]
+
+		key = str(request.submission_id)
+		self._pending_submissions[key].remove(request)
+		if not self._pending_submissions[key]:
+			del self._pending_submissions[key]
+
+	def pending_requests_for(self, submission_id):
+		"""
+		Returns a list of the pending requests (see is_request_pending()) for
+		the given submission, whatever test harness they're for.
+
+		"""
+
+		return list(self._pending_submissions.get(str(submission_id), ()))
+
+	def is_request_pending(self, request):
+		"""
+		Returns True if an equal request is waiting for a sheep, is being
+		serviced, or is waiting to be retried.
+
+		"""
+
+		return (request in self._request_queue or
+			request in self._assigned_requests or
+			request in self._deferred_requests)
+
+	def restore_requests(self, requests):
+		"""
+		Places many (request, arrival time) tuples into the request queue at
+		once, without journaling them or looking for matches. Meant to be used
+		at startup to restore the requests recovered from the journal.
+
+		"""
+
+		requests = [i for i in requests if not self.is_request_pending(i[0])]
+
+		# Updating the request queue all at once rebuilds its heap once rather
+		# than pushing onto it once per request.
+		self._request_queue.update(requests)
+
+		for request, arrival_time in requests:
+			self._track_pending(request, arrival_time)
+			self._request_index.add(
+				request,
+				request.environment,
+				self._request_priority(request, arrival_time)
+			)
+
+	def received_request(self, request, arrival_time = None):
+		"""
+		Called externally whenever a test request has arrived. Returns False if
+		the request duplicates a pending request (see is_request_pending()), in
+		which case it is dropped.
 
-	def received_request(self, request):
-		"""Called externally whenever a test request has arrived."""
+		arrival_time is when the request first arrived if that wasn't just now
+		(ex: because it's being retried), so that it keeps its place in line.
+
+		"""
 
 		assert isinstance(request, InternalTestRequest)
 
-		self._request_queue[request] = datetime.datetime.now()
+		if self.is_request_pending(request):
+			return False
+
+		if arrival_time is None:
+			arrival_time = datetime.datetime.now()
+
+		self._request_queue[request] = arrival_time
+		self._track_pending(request, arrival_time)
+		self._request_index.add(
+			request,
+			request.environment,
+			self._request_priority(request, arrival_time)
+		)
+
+		if self.journal is not None:
+			self.journal.add(request, arrival_time)
 
-		# Go through every available sheep and check to see if a match exists
-		for i in self._bleet_queue.keys():
-			if FlockManager.check_environments(request.environment,
-					self._flock[i].environment):
+		# Go through every available sheep that could service the request and
+		# check to see if a match exists.
+		for bucket in self._idle_index.buckets_covering(request.environment):
+			for i in list(bucket):
 				if self._dispatch_match_found(i, request):
-					break
+					return True
+
+				# match_found may have found there's nothing left to test and
+				# discarded the request, in which case no sheep will take it.
+				if request not in self._request_queue:
+					return True
+
+		return True
+
+	def discard_request(self, request):
+		"""
+		Forgets about a request that is waiting for a sheep. Returns False if
+		the request was not waiting.
 
-	def manage_sheep(self, identity, environment):
+		"""
+
+		if request not in self._request_queue:
+			return False
+
+		del self._request_queue[request]
+		self._request_index.discard(request)
+		self._untrack_pending(request)
+
+		if self.journal is not None:
+			self.journal.remove(request)
+
+		return True
+
+	def manage_sheep(self, identity, environment, slots = None):
 		"""
 		Tell the flock manager to keep track of the given sheep. Returns True if
 		the sheep has not previously been added. Returns False if the sheep was
 		already known by the manager.
 
+		slots is the number of requests the sheep can service concurrently, or
+		None if the sheep didn't say (in which case it has one).
+
 		Calls sheep_bleeted on the sheep as well.
 
 		"""
@@ -96,7 +366,15 @@ class FlockManager:
 		if not isinstance(environment, dict):
 			raise TypeError("environment must be a dict.")
 
-		self._flock[identity] = FlockManager.SheepInfo(environment, None)
+		counts_slots = slots is not None
+		if slots is None:
+			slots = 1
+		elif slots < 1:
+			raise ValueError("slots must be positive.")
+
+		self._flock[identity] = \
+			FlockManager.SheepInfo(environment, slots, counts_slots)
+		self._total_slots += slots
 
 		self.sheep_bleeted(identity)
 
@@ -106,66 +384,180 @@ class FlockManager:
 		if identity not in self._flock:
 			raise ValueError("No sheep with given identity.")
 
+		for request in self._forget_sheep(identity):
+			self._untrack_pending(request)
+
+	def _forget_sheep(self, identity):
+		"""
+		Removes a sheep and any requests it was servicing from every queue.
+		Returns the requests the sheep was servicing.
+
+		"""
+
+		requests = self._flock[identity].servicing_requests
+
+		for i in requests:
+			if (identity, i) in self._service_queue:
+				del self._service_queue[(identity, i)]
+
+			del self._assigned_requests[i]
+
+		self._total_slots -= self._flock[identity].slots
 		del self._flock[identity]
 
+		self._idle_index.discard(identity)
+
 		if identity in self._bleet_queue:
 			del self._bleet_queue[identity]
 
-		if identity in self._service_queue:
-			del self._service_queue[identity]
+		return requests
 
 	IGNORE = "ignore"
-	def sheep_bleeted(self, identity):
+	def sheep_bleeted(self, identity, free_slots = None):
 		"""
 		Should be called whenever a sheep bleets. Will return True if all is
 		well, will return False if the sheep is not recognized and do nothing.
 
+		free_slots is the number of requests the sheep says it is ready to
+		receive, or None if the sheep didn't say. Because requests may be in
+		flight when the sheep bleets this is only used as an upper bound, the
+		sheep must be prepared to hold on to requests it wasn't ready for.
+
 		"""
 
 		if not self.is_sheep_managed(identity):
 			return False
 
-		# If the sheep is listed as servicing a request, this bleet may have
-		# come in before the shepherd sent the test request to the sheep, in
-		# which case we just want to ignore the bleet.
-		if identity in self._service_queue:
-			return FlockManager.IGNORE
+		info = self._flock[identity]
 
-		# Check whether we're in the bleet queue before we add ourselves to
-		# it.
-		newly_available = identity not in self._bleet_queue
+		if free_slots is not None:
+			info.ready = free_slots
 
-		self._bleet_queue[identity] = datetime.datetime.now()
+		if info.free_slots() <= 0:
+			# If an older sheep is listed as servicing a request, this bleet
+			# may have come in before the shepherd sent the test request to
+			# the sheep, in which case we just want to ignore the bleet.
+			if not info.counts_slots:
+				return FlockManager.IGNORE
 
-		if newly_available:
+			# A sheep that counts its slots keeps bleeting while it is busy
+			# (even if it has only one). It isn't available but it is alive,
+			# and it will assume we're gone if it isn't answered.
+			return True
+
+		if self.bleet_timeout:
+			self._bleet_queue[identity] = \
+				monotonic() + self.bleet_timeout.total_seconds()
+		else:
+			self._bleet_queue[identity] = float("inf")
+
+		if not info.is_available():
+			self._idle_index.discard(identity)
+		elif identity not in self._idle_index:
 			self._sheep_available(identity)
 
 		return True
 
-	def sheep_finished(self, identity):
-		if identity not in self._service_queue:
+	def sheep_finished(self, identity, submission_id = None):
+		"""
+		Should be called whenever a sheep returns a result for the request
+		for the given submission. If submission_id is None, the sheep must be
+		servicing a single request and that request is considered finished.
+
+		Returns False if the sheep was not servicing a matching request.
+
+		"""
+
+		if not self.is_sheep_managed(identity):
+			return False
+
+		info = self._flock[identity]
+
+		for request in info.servicing_requests:
+			if submission_id is None or \
+					str(request.submission_id) == str(submission_id):
+				break
+		else:
+			return False
+
+		if submission_id is None and len(info.servicing_requests) != 1:
 			return False
 
-		del self._service_queue[identity]
-		self._flock[identity].servicing_request = None
+		info.servicing_requests.remove(request)
+		del self._service_queue[(identity, request)]
+		_, start_time = self._assigned_requests.pop(request)
+		self._untrack_pending(request)
+
+		service_time = \
+			(datetime.datetime.now() - start_time).total_seconds()
+		metrics.service_time.observe(
+			service_time, assignment = str(request.assignment_id)
+		)
+
+		if self.average_service_time is None:
+			self.average_service_time = service_time
+		else:
+			self.average_service_time += self.service_time_smoothing * \
+				(service_time - self.average_service_time)
+
+		if self.journal is not None:
+			self.journal.remove(request)
 
 		return True
 
 
+	def _service_deadline(self, request):
+		"""
+		Returns the time (in seconds as given by monotonic()) at which a sheep
+		that starts servicing request now should be assumed dead.
+
+		"""
+
+		if request.timeout:
+			allowed = datetime.timedelta(seconds = request.timeout)
+		elif self.service_timeout:
+			allowed = self.service_timeout
+		else:
+			return float("inf")
+
+		if self.service_grace:
+			allowed += self.service_grace
+
+		return monotonic() + allowed.total_seconds()
+
 	def assign_sheep(self, identity, request):
 		"""Assigns a particular request to a sheep."""
 
 		assert request in self._request_queue
-		assert identity in self._bleet_queue
+		assert identity in self._idle_index
+
+		info = self._flock[identity]
+		now = datetime.datetime.now()
 
-		# Delete the sheep and request from their respective queues
+		metrics.match_latency.observe(
+			(now - self._request_queue[request]).total_seconds()
+		)
+
+		# Delete the request from the request queue
 		del self._request_queue[request]
-		del self._bleet_queue[identity]
+		self._request_index.discard(request)
+
+		# Make note of when the sheep should be done with the request
+		self._service_queue[(identity, request)] = \
+			self._service_deadline(request)
 
-		# Make note of when the sheep started on the request
-		self._service_queue[identity] = datetime.datetime.now()
+		info.servicing_requests.add(request)
+		self._assigned_requests[request] = (identity, now)
+		if info.ready is not None:
+			info.ready -= 1
 
-		self._flock[identity].servicing_request = request
+		# Take the sheep out of the available sheep if it can't take more, and
+		# out of the bleet queue if it's completely busy.
+		if not info.is_available():
+			self._idle_index.discard(identity)
+
+		if info.free_slots() <= 0:
+			del self._bleet_queue[identity]
 
 	@staticmethod
 	def check_environments(a, b):
@@ -185,44 +577,176 @@ class FlockManager:
 	def is_sheep_managed(self, identity):
 		return identity in self._flock
 
+	def queue_depth(self):
+		"""
+		Returns the number of requests waiting for a sheep, including those
+		waiting to be retried.
+
+		"""
+
+		return len(self._request_queue) + len(self._deferred_requests)
+
+	def idle_sheep(self):
+		"""Returns the number of sheep with at least one free slot."""
+
+		return len(self._bleet_queue)
+
+	def busy_sheep(self):
+		"""
+		Returns the number of sheep servicing at least one request.
+
+		"""
+
+		return sum(1 for i in self._flock.itervalues() if i.servicing_requests)
+
+	def estimated_wait(self):
+		"""
+		Returns a rough estimate, in seconds, of how long a request arriving
+		now would wait before being serviced, or None if there's no basis for
+		an estimate yet.
+
+		"""
+
+		if self.average_service_time is None or not self._total_slots:
+			return None
+
+		return (self.queue_depth() * self.average_service_time /
+			self._total_slots)
+
+	def status(self):
+		"""
+		Returns a dictionary describing the state of the flock, suitable for
+		sending to the outside.
+
+		"""
+
+		return {
+			"queue_depth": self.queue_depth(),
+			"in_service": len(self._assigned_requests),
+			"sheep": len(self._flock),
+			"idle_sheep": self.idle_sheep(),
+			"busy_sheep": self.busy_sheep(),
+			"slots": self._total_slots,
+			"estimated_wait": self.estimated_wait(),
+			"dead_letters": len(self.dead_letters)
+		}
+
+	def dead_letter_summary(self):
+		"""
+		Returns a list of dictionaries describing the requests that were given
+		up on (see dead_letters), oldest first, suitable for sending to the
+		outside.
+
+		"""
+
+		return [
+			{
+				"submission_id": str(request.submission_id),
+				"harness_id": None if request.harness_id is None
+					else str(request.harness_id),
+				"time": given_up.isoformat()
+			} for request, given_up in self.dead_letters
+		]
+
+	def next_deadline(self):
+		"""
+		Returns the earliest time (a datetime) at which cleanup() may have
+		something to do, or None if there is nothing that can time out.
+
+		"""
+
+		deadlines = []
+
+		for i in (self._bleet_queue, self._service_queue):
+			expiry = i.next_expiry()
+			if expiry is not None:
+				deadlines.append(datetime.datetime.now() +
+					datetime.timedelta(seconds = expiry - monotonic()))
+
+		if self._deferred_requests:
+			deadlines.append(self._deferred_requests.smallest().priority)
+
+		return min(deadlines) if deadlines else None
+
+	def _retry_request(self, request):
+		"""
+		Schedules a request whose sheep died to be placed back into the
+		request queue after a delay. Returns False if the request has run out
+		of retries and was added to the dead letters instead.
+
+		"""
+
+		now = datetime.datetime.now()
+
+		request.retries += 1
+		if request.retries > self.max_retries:
+			self.dead_letters.append((request, now))
+			self._untrack_pending(request)
+
+			if self.journal is not None:
+				self.journal.remove(request)
+
+			return False
+
+		delay = datetime.timedelta(0)
+		if self.retry_backoff:
+			delay = self.retry_backoff * 2 ** (request.retries - 1)
+
+		self._deferred_requests[request] = now + delay
+
+		return True
+
 	def cleanup(self):
 		"""
-		Returns two lists in a tuple where the first list is any sheep who timed
-		out due to bleets (lost sheep), and the second list is any sheep that
-		timed out while servicing a request (killed sheep).
+		Returns three lists in a tuple where the first list is any sheep who
+		timed out due to bleets (lost sheep), the second list is any sheep that
+		timed out while servicing a request (killed sheep), and the third list
+		is any requests that were given up on because they ran out of retries
+		(dead requests).
 
-		Any lost sheep will simply be forgotten about, any killed sheep will
-		have the test request they were servicing placed back into the request
-		queue than they will be forgotten about as well.
+		Lost and killed sheep are forgotten about, and any test requests they
+		were servicing (a lost sheep with several slots may have been servicing
+		some) are placed back into the request queue after a delay. A sheep
+		that is both lost and killed is only reported as killed.
 
 		"""
 
 		lost_sheep = []
 		killed_sheep = []
-
-		# Find all the sheep who are not servicing requests but have not bleeted
-		# in awhile.
-		if self.bleet_timeout:
-			while (self._bleet_queue and self._bleet_queue.smallest().priority <
-					datetime.datetime.now() - self.bleet_timeout):
-				lost_sheep.append(self._bleet_queue.pop_smallest().value)
-
-		# Find all the sheep who have been servicing a single request too long.
-		if self.service_timeout:
-			while (self._service_queue and
-					self._service_queue.smallest().priority <
-					datetime.datetime.now() - self.service_timeout):
-				killed_sheep.append(self._service_queue.pop_smallest().value)
-
-		# Any lost sheep can simply be forgotten about as if they never existed.
-		for i in lost_sheep:
-			self.remove_sheep(i)
-
-		# Any killed sheep needs to have the test request they were servicing
-		# put back into the request queue again and then they need to be
-		# forgotten.
-		for i in killed_sheep:
-			#self.received_request(self._flock[i].servicing_request)
-			self.remove_sheep(i)
-
-		return lost_sheep, killed_sheep
+		dead_requests = []
+
+		now = monotonic()
+
+		# Find all the sheep who have been servicing a request too long.
+		for identity, _ in self._service_queue.pop_expired(now):
+			if identity not in killed_sheep:
+				killed_sheep.append(identity)
+
+		# Find all the sheep who have not bleeted in awhile. A sheep with
+		# several slots can be in both lists.
+		for identity in self._bleet_queue.pop_expired(now):
+			if identity not in killed_sheep:
+				lost_sheep.append(identity)
+
+		# Every one of these sheep needs to have the test requests it was
+		# servicing scheduled to be put back into the request queue again and
+		# then it needs to be forgotten.
+		for i in killed_sheep + lost_sheep:
+			if i not in self._flock:
+				continue
+
+			for request in self._forget_sheep(i):
+				if not self._retry_request(request):
+					dead_requests.append(request)
+
+		# Place any requests that have waited out their delay back into the
+		# request queue.
+		while (self._deferred_requests and
+				self._deferred_requests.smallest().priority <=
+				datetime.datetime.now()):
+			request = self._deferred_requests.pop_smallest().value
+			arrival_time = self._arrival_times[request]
+			self._untrack_pending(request)
+			self.received_request(request, arrival_time)
+
+		return lost_sheep, killed_sheep, dead_requests
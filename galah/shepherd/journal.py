@@ -0,0 +1,178 @@
+from galah.base.flockmail import InternalTestRequest
+from bson.objectid import ObjectId
+import datetime
+import json
+import os
+
+import logging
+logger = logging.getLogger("galah.shepherd.journal")
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+def _to_timestamp(value):
+    return None if value is None else (value - _EPOCH).total_seconds()
+
+def _from_timestamp(value):
+    return None if value is None else \
+        _EPOCH + datetime.timedelta(seconds = value)
+
+def _serialize_request(request):
+    return {
+        "submission_id": str(request.submission_id),
+        "timeout": request.timeout,
+        "environment": request.environment,
+        "deadline": _to_timestamp(request.deadline),
+        "retries": request.retries,
+        "harness_id":
+            None if request.harness_id is None else str(request.harness_id),
+        "priority_class": request.priority_class,
+        "assignment_id": None if request.assignment_id is None else
+            str(request.assignment_id)
+    }
+
+def _deserialize_request(raw):
+    return InternalTestRequest(
+        ObjectId(raw["submission_id"]),
+        raw["timeout"],
+        raw["environment"],
+        _from_timestamp(raw["deadline"]),
+        raw["retries"],
+        None if raw["harness_id"] is None else ObjectId(raw["harness_id"]),
+        raw.get("priority_class"),
+        None if raw.get("assignment_id") is None else
+            ObjectId(raw["assignment_id"])
+    )
+
+class RequestJournal:
+    """
+    An append-only file recording every test request the shepherd has
+    accepted but not finished with (both the requests waiting for a sheep and
+    the requests being serviced), so they can be recovered if the shepherd
+    restarts.
+
+    Each line of the file is a JSON object recording either that a request
+    was added or that a request was removed. When removed requests make up
+    most of the file it is compacted by rewriting it with only the live
+    requests.
+
+    """
+
+    def __init__(self, path, fsync = False, min_compact_size = 1000):
+        self.path = path
+
+        # If True, every write is flushed all the way to disk. Otherwise
+        # writes survive the shepherd crashing, but not the machine crashing.
+        self.fsync = fsync
+
+        # The journal will not be compacted until it has at least this many
+        # records in it.
+        self.min_compact_size = min_compact_size
+
+        # Maps request keys (see _key()) to the record that added them.
+        self._live = {}
+
+        # The number of records in the file.
+        self._size = 0
+
+        self._file = None
+
+    @staticmethod
+    def _key(request):
+        return "%s/%s" % (request.submission_id, request.harness_id)
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, separators = (",", ":")) + "\n")
+        self._file.flush()
+
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+        self._size += 1
+
+    def replay(self):
+        """
+        Reads the journal and returns a list of (request, arrival time) tuples
+        for every request that was not finished, oldest first. Must be called
+        once before the journal is written to.
+
+        """
+
+        self._live = {}
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Most likely the last line, cut off by a crash.
+                        logger.warning(
+                            "Skipping corrupt record in request journal."
+                        )
+                        continue
+
+                    if record["op"] == "add":
+                        self._live[record["key"]] = record
+                    elif record["op"] == "remove":
+                        self._live.pop(record["key"], None)
+
+        records = sorted(self._live.values(), key = lambda i: i["time"])
+
+        # Start over with a file containing only what we need.
+        self._compact()
+
+        return [
+            (_deserialize_request(i["request"]), _from_timestamp(i["time"]))
+                for i in records
+        ]
+
+    def _compact(self):
+        if self._file is not None:
+            self._file.close()
+
+        # Write the new journal next to the old one and then swap them so
+        # there's always a complete journal on disk.
+        temp_path = self.path + ".compact"
+        with open(temp_path, "w") as f:
+            for i in self._live.values():
+                f.write(json.dumps(i, separators = (",", ":")) + "\n")
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(temp_path, self.path)
+
+        self._file = open(self.path, "a")
+        self._size = len(self._live)
+
+    def _maybe_compact(self):
+        if self._size >= max(self.min_compact_size, 2 * len(self._live)):
+            self._compact()
+
+    def add(self, request, arrival_time):
+        """Records that a request has been accepted."""
+
+        record = {
+            "op": "add",
+            "key": RequestJournal._key(request),
+            "request": _serialize_request(request),
+            "time": _to_timestamp(arrival_time)
+        }
+
+        self._live[record["key"]] = record
+        self._write(record)
+
+    def remove(self, request):
+        """Records that we are finished with a request."""
+
+        key = RequestJournal._key(request)
+        if self._live.pop(key, None) is None:
+            return
+
+        self._write({"op": "remove", "key": key})
+        self._maybe_compact()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
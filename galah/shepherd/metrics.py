@@ -0,0 +1,269 @@
+"""
+Instrumentation for the shepherd.
+
+Every metric the shepherd keeps is defined at the bottom of this module and
+registered with the module's registry, which can render all of them in the
+Prometheus text exposition format. The shepherd serves that text on its stats
+socket (see shepherd/STATS_SOCKET).
+
+"""
+
+import bisect
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value))
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+
+    escaped = (
+        str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+            for v in values
+    )
+
+    return "{%s}" % ",".join(
+        "%s=\"%s\"" % (k, v) for k, v in zip(names, escaped)
+    )
+
+class _Metric(object):
+    """
+    Base class for all metrics. A metric may have any number of labels, and
+    keeps a separate value for every combination of label values it sees.
+
+    """
+
+    type = None
+
+    def __init__(self, name, description, labels = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+
+        # Maps tuples of label values to that combination's value.
+        self._values = {}
+
+    def _label_values(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(
+                "Expected labels %s for metric %s, got %s." %
+                    (self.labels, self.name, tuple(labels))
+            )
+
+        return tuple(labels[i] for i in self.labels)
+
+    def clear(self):
+        self._values.clear()
+
+    def _samples(self):
+        """
+        Yields (suffix, label names, label values, value) tuples for every
+        sample this metric has.
+
+        """
+
+        for label_values, value in sorted(self._values.items()):
+            yield "", self.labels, label_values, value
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.description),
+            "# TYPE %s %s" % (self.name, self.type)
+        ]
+
+        for suffix, names, values, value in self._samples():
+            lines.append("%s%s%s %s" % (
+                self.name, suffix, _format_labels(names, values),
+                _format_value(value)
+            ))
+
+        return "\n".join(lines)
+
+class Counter(_Metric):
+    """A value that only ever goes up."""
+
+    type = "counter"
+
+    def inc(self, amount = 1, **labels):
+        key = self._label_values(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    """
+    A value that can go up and down. Rather than being set, an unlabelled gauge
+    can be given a function that is called whenever the gauge is rendered.
+
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, description, labels = ()):
+        _Metric.__init__(self, name, description, labels)
+
+        self._function = None
+
+    def set(self, value, **labels):
+        self._values[self._label_values(labels)] = value
+
+    def set_function(self, function):
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            yield "", (), (), self._function()
+        else:
+            for i in _Metric._samples(self):
+                yield i
+
+# Bucket boundaries, in seconds, suitable for anything from a database write to
+# a long running test.
+DEFAULT_BUCKETS = (
+    0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600
+)
+
+class Histogram(_Metric):
+    """
+    Counts observations in buckets so their distribution can be seen, along
+    with their sum and count.
+
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, description, labels = (),
+            buckets = DEFAULT_BUCKETS):
+        _Metric.__init__(self, name, description, labels)
+
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._label_values(labels)
+
+        # Each entry is [bucket counts..., sum, count]. The bucket counts are
+        # not cumulative here, they are summed up when rendered.
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [0] * (len(self.buckets) + 2)
+
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            entry[index] += 1
+
+        entry[-2] += value
+        entry[-1] += 1
+
+    def _samples(self):
+        bucket_labels = self.labels + ("le", )
+
+        for label_values, entry in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                yield ("_bucket", bucket_labels,
+                    label_values + (_format_value(bound), ), cumulative)
+
+            yield "_bucket", bucket_labels, label_values + ("+Inf", ), entry[-1]
+            yield "_sum", self.labels, label_values, entry[-2]
+            yield "_count", self.labels, label_values, entry[-1]
+
+class Registry:
+    """A collection of metrics that can be rendered all at once."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+        return metric
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+
+        return "".join(i.render() + "\n" for i in self._metrics)
+
+registry = Registry()
+
+request_queue_depth = registry.register(Gauge(
+    "galah_shepherd_request_queue_depth",
+    "Test requests waiting for a sheep, including those waiting to be retried."
+))
+
+idle_sheep = registry.register(Gauge(
+    "galah_shepherd_idle_sheep",
+    "Sheep that have at least one free slot."
+))
+
+busy_sheep = registry.register(Gauge(
+    "galah_shepherd_busy_sheep",
+    "Sheep that are servicing at least one test request."
+))
+
+requests_received = registry.register(Counter(
+    "galah_shepherd_requests_received_total",
+    "Test requests accepted into the request queue."
+))
+
+requests_rejected = registry.register(Counter(
+    "galah_shepherd_requests_rejected_total",
+    "Test requests turned away, by reason.",
+    labels = ("reason", )
+))
+
+requests_dead = registry.register(Counter(
+    "galah_shepherd_requests_dead_total",
+    "Test requests given up on after running out of retries."
+))
+
+sheep_lost = registry.register(Counter(
+    "galah_shepherd_sheep_lost_total",
+    "Sheep forgotten about, by reason.",
+    labels = ("reason", )
+))
+
+match_latency = registry.register(Histogram(
+    "galah_shepherd_match_latency_seconds",
+    "Time from a test request arriving to it being sent to a sheep."
+))
+
+service_time = registry.register(Histogram(
+    "galah_shepherd_service_time_seconds",
+    "Time from a test request being sent to a sheep to its result arriving.",
+    labels = ("assignment", )
+))
+
+bleet_latency = registry.register(Histogram(
+    "galah_shepherd_bleet_latency_seconds",
+    "Time from a bleet being received to its reply being sent.",
+    buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+))
+
+db_write_latency = registry.register(Histogram(
+    "galah_shepherd_db_write_latency_seconds",
+    "Time taken to write a batch of test results to the database."
+))
+
+results_dead = registry.register(Counter(
+    "galah_shepherd_results_dead_total",
+    "Test results given up on after they could not be written."
+))
+
+result_queue_depth = registry.register(Gauge(
+    "galah_shepherd_result_queue_depth",
+    "Test results waiting to be written to the database."
+))
+
+cache_hits = registry.register(Gauge(
+    "galah_shepherd_document_cache_hits",
+    "Document cache lookups that were answered from the cache.",
+    labels = ("cache", )
+))
+
+cache_misses = registry.register(Gauge(
+    "galah_shepherd_document_cache_misses",
+    "Document cache lookups that had to go to the database.",
+    labels = ("cache", )
+))
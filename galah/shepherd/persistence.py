@@ -0,0 +1,225 @@
+from galah.db.models import Submission, TestResult
+from bson.objectid import ObjectId
+from bson.errors import InvalidDocument
+from mongoengine.errors import NotUniqueError
+from galah.shepherd import metrics
+from collections import deque
+import datetime
+import threading
+import time
+import Queue
+
+import logging
+logger = logging.getLogger("galah.shepherd.persistence")
+
+class ResultWriter:
+    """
+    Saves test results to the database from a background thread so the
+    shepherd's main loop never waits on a database write.
+
+    Results are placed in a bounded queue with put(). The writer thread takes
+    as many results as are waiting (up to batch_size), inserts all of their
+    TestResult documents at once, and then points each submission at its new
+    test result. A batch that can't be written (ex: because the database is
+    down) is retried, with a growing delay, up to max_attempts times. After
+    that its results are tried one at a time, and any result that still can't
+    be written is logged and added to the dead letters so that one bad result
+    can't hold up the rest forever. Results are always written in the order
+    they were put.
+
+    """
+
+    # The longest, in seconds, to wait between attempts to write a batch that
+    # could not be written.
+    MAX_RETRY_DELAY = 60
+
+    def __init__(self, max_queue_size, batch_size, max_attempts = 8,
+            dead_letter_limit = 1000):
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+
+        # (submission_id, time given up) tuples for the results that could not
+        # be written, oldest first. Only the most recent dead_letter_limit are
+        # kept.
+        self.dead_letters = deque(maxlen = dead_letter_limit)
+
+        # Holds (submission_id, raw_result, overflow) tuples waiting to be
+        # written.
+        self._queue = Queue.Queue(maxsize = max_queue_size)
+
+        self._thread = threading.Thread(
+            target = self._run, name = "result-writer"
+        )
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def put(self, submission_id, raw_result, overflow = None):
+        """
+        Queues a test result to be written, along with the overflow document
+        holding any output that was cut from it (see
+        galah.sheep.utility.results), if there is one. If the queue is full
+        this blocks until the writer makes room, which holds up the caller
+        rather than letting results pile up without bound.
+
+        """
+
+        item = (submission_id, raw_result, overflow)
+
+        try:
+            self._queue.put_nowait(item)
+        except Queue.Full:
+            logger.warn("Result queue is full, waiting for the writer.")
+
+            self._queue.put(item)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            test_results = \
+                [ResultWriter._to_test_result(*i) for i in batch]
+
+            # The sheep that sent these results have already been told they're
+            # safe, so try hard to make sure they are.
+            delay = 1
+            for attempt in xrange(1, self.max_attempts + 1):
+                try:
+                    self._store(batch, test_results)
+                    break
+                except Exception:
+                    if attempt == self.max_attempts:
+                        logger.exception(
+                            "Could not write %d test results to the database "
+                            "after %d attempts, writing them one at a time.",
+                            len(batch),
+                            attempt
+                        )
+
+                        self._store_each(batch, test_results)
+                        break
+
+                    logger.exception(
+                        "Could not write %d test results to the database, "
+                        "trying again in %d seconds.",
+                        len(batch),
+                        delay
+                    )
+
+                    time.sleep(delay)
+                    delay = min(delay * 2, ResultWriter.MAX_RETRY_DELAY)
+
+    def _store_each(self, batch, test_results):
+        """
+        Stores the results of a batch one at a time, giving up on (and
+        dead lettering) any that can't be stored.
+
+        """
+
+        for item, test_result in zip(batch, test_results):
+            try:
+                self._store([item], [test_result])
+            except Exception:
+                submission_id, raw_result, _ = item
+
+                logger.exception(
+                    "Giving up on test result for submission [%s]: %r",
+                    str(submission_id),
+                    raw_result
+                )
+
+                metrics.results_dead.inc()
+                self.dead_letters.append(
+                    (submission_id, datetime.datetime.now())
+                )
+
+    @staticmethod
+    def _to_test_result(submission_id, raw_result, overflow = None):
+        try:
+            test_result = TestResult.from_dict(raw_result)
+        except Exception:
+            logger.warn(
+                "Received malformed test result for submission [%s].",
+                str(submission_id),
+                exc_info = True
+            )
+
+            test_result = TestResult(failed = True)
+
+        test_result.id = ObjectId()
+
+        # The overflow goes into GridFS, which has no limit on document size.
+        # GridFS stores bytes, and the chunks that make up the overflow are
+        # decoded into unicode along with the rest of their message.
+        if overflow is not None:
+            if isinstance(overflow, unicode):
+                overflow = overflow.encode("utf-8")
+
+            try:
+                test_result.overflow.put(
+                    overflow, content_type = "application/json"
+                )
+            except Exception:
+                logger.warn(
+                    "Could not store overflow for submission [%s].",
+                    str(submission_id),
+                    exc_info = True
+                )
+
+        return test_result
+
+    def _store(self, batch, test_results):
+        """
+        Inserts the TestResult documents made from a batch and points their
+        submissions at them. Safe to call again with the same documents if it
+        fails part way through.
+
+        """
+
+        start_time = time.time()
+
+        try:
+            TestResult.objects.insert(test_results, load_bulk = False)
+        except (InvalidDocument, NotUniqueError):
+            # At least one of the results is too big to be stored, or was
+            # stored by an earlier attempt. Fall back to saving them one at a
+            # time so the rest are kept intact.
+            for i, test_result in enumerate(test_results):
+                try:
+                    test_result.save(force_insert = True)
+                except NotUniqueError:
+                    # Made it in before the bulk insert failed.
+                    pass
+                except InvalidDocument:
+                    logger.warn(
+                        "Test result is too large for the database.",
+                        exc_info = True
+                    )
+
+                    test_results[i] = TestResult(failed = True)
+                    test_results[i].save()
+
+        # The submissions don't need to be loaded, we only need to change a
+        # single field on each.
+        for (submission_id, _, _), test_result in zip(batch, test_results):
+            updated = Submission.objects(id = submission_id).update_one(
+                set__test_results = test_result.id
+            )
+
+            if not updated:
+                logger.warn(
+                    "Could not retrieve submission [%s] for test result.",
+                    str(submission_id)
+                )
+
+        metrics.db_write_latency.observe(time.time() - start_time)
@@ -4,13 +4,22 @@
 
 import sys
 from galah.base.flockmail import FlockMessage, TestRequest, InternalTestRequest
-from galah.base.zmqhelpers import router_send_json, router_recv_json
+from galah.base.zmqhelpers import router_send_json, router_recv_json, \
+    router_send, router_recv, router_send_message, decode, parse_bleet_frame, \
+    bloot_frame, BLEET_FRAME
 from flockmanager import FlockManager
-from galah.db.models import (Submission, Assignment, TestHarness, TestResult,
-                             User)
+from documentcache import DocumentCache
+from persistence import ResultWriter
+from journal import RequestJournal
+from galah.shepherd import metrics
+from galah.db.models import Submission, Assignment, TestHarness, User
 from bson.objectid import ObjectId
-from bson.errors import InvalidId, InvalidDocument
+from bson.errors import InvalidId
+from collections import namedtuple
 import datetime
+import math
+import time
+import os
 
 # Load Galah's configuration.
 from galah.base.config import load_config
@@ -20,6 +29,46 @@ config = load_config("shepherd")
 import logging
 logger = logging.getLogger("galah.shepherd")
 
+def _shard_path(path, shard_name):
+    """
+    Returns a version of an ipc:// address or a file path that's unique to
+    the given shard, ex: ipc:///tmp/shepherd-stats.sock becomes
+    ipc:///tmp/shepherd-stats-a.sock for the shard named a.
+
+    """
+
+    root, extension = os.path.splitext(path)
+    return "%s-%s%s" % (root, shard_name, extension)
+
+# When several shepherds are run, each is told which shard it is through the
+# environment and takes its sockets (and anything else it must not share with
+# the others, like its journal) from that shard's entry in SHARDS.
+shard_name = os.environ.get("GALAH_SHEPHERD_SHARD")
+if shard_name is not None:
+    for shard in config["SHARDS"] or []:
+        if shard["NAME"] == shard_name:
+            config.update(shard)
+            break
+    else:
+        raise ValueError("No shard named %s in SHARDS." % repr(shard_name))
+
+    # Shards that don't name their own stats socket or journal get one
+    # derived from the shared setting, otherwise every shard would try to
+    # bind the same socket and write the same journal. Only ipc:// sockets
+    # can be derived this way, there's no telling which TCP ports are free.
+    if "STATS_SOCKET" not in shard and config["STATS_SOCKET"]:
+        if not config["STATS_SOCKET"].startswith("ipc://"):
+            raise ValueError(
+                "Shard %s must set its own STATS_SOCKET." % repr(shard_name)
+            )
+
+        config["STATS_SOCKET"] = \
+            _shard_path(config["STATS_SOCKET"], shard_name)
+
+    if "REQUEST_JOURNAL" not in shard and config["REQUEST_JOURNAL"]:
+        config["REQUEST_JOURNAL"] = \
+            _shard_path(config["REQUEST_JOURNAL"], shard_name)
+
 # Connect to the mongo database
 import mongoengine
 mongoengine.connect(config["MONGODB"])
@@ -31,10 +80,194 @@ context = zmq.Context()
 sheep = context.socket(zmq.ROUTER)
 sheep.bind(config["SHEEP_SOCKET"])
 
-# Socket to communicate with other components
-public = context.socket(zmq.DEALER)
+# Socket to communicate with other components. A ROUTER so we can answer
+# queries from whoever sent them.
+public = context.socket(zmq.ROUTER)
 public.bind(config["PUBLIC_SOCKET"])
 
+# Socket that answers any request with the shepherd's metrics in the
+# Prometheus text format.
+stats = None
+if config["STATS_SOCKET"]:
+    stats = context.socket(zmq.REP)
+    stats.bind(config["STATS_SOCKET"])
+
+# The documents needed to send a test request to a sheep. Loaded once when
+# the request is received and handed to match_found.
+RequestDocuments = namedtuple(
+    "RequestDocuments", ("submission", "assignment", "test_harness", "user")
+)
+
+# Maps submission ids to the RequestDocuments loaded for them when their test
+# request was received. Entries are removed once the request is sent to a
+# sheep.
+loaded_documents = {}
+
+# Maps (sheep identity, submission id) tuples to the overflow chunks (see
+# galah.sheep.utility.results) received so far for a test result that hasn't
+# arrived yet. Each entry is a dict with the chunks, their total size, and
+# whether any were dropped for going over shepherd/MAX_OVERFLOW_SIZE.
+result_chunks = {}
+
+# Maps sheep identities to the wire format (see galah.base.zmqhelpers) each
+# sheep last spoke to us in, so we can answer in kind.
+sheep_wire_formats = {}
+
+def send_to_sheep(sheep_identity, message):
+    router_send_message(
+        sheep,
+        sheep_identity,
+        message.to_dict(),
+        sheep_wire_formats.get(sheep_identity, "json")
+    )
+
+# Caches for the documents that are shared between many submissions. Test
+# harnesses are never modified in place (uploading a new harness creates a new
+# document) but assignments and users are, so the time-to-live bounds how long
+# we may use stale information.
+assignment_cache = DocumentCache(
+    config["DOCUMENT_CACHE_SIZE"], config["DOCUMENT_CACHE_TTL"]
+)
+test_harness_cache = DocumentCache(
+    config["DOCUMENT_CACHE_SIZE"], config["DOCUMENT_CACHE_TTL"]
+)
+user_cache = DocumentCache(
+    config["DOCUMENT_CACHE_SIZE"], config["DOCUMENT_CACHE_TTL"]
+)
+
+def cached_lookup(cache, document_type, field, keys):
+    """
+    Returns a dictionary mapping each of keys to the document of type
+    document_type whose field matches it. Documents are taken from cache if
+    possible, and any that aren't there are fetched with a single query and
+    added to it. Keys without a matching document are left out.
+
+    """
+
+    result = {}
+    missing = []
+    for i in set(keys):
+        document = cache.get(i)
+        if document is None:
+            missing.append(i)
+        else:
+            result[i] = document
+
+    if missing:
+        for document in document_type.objects(**{field + "__in": missing}):
+            key = getattr(document, field)
+
+            cache.put(key, document)
+            result[key] = document
+
+    return result
+
+def load_request_documents(submission_ids):
+    """
+    Loads every document needed to service test requests for the given
+    submissions, using one query per collection rather than several queries
+    per submission.
+
+    Returns a dictionary mapping submission ids to RequestDocuments objects.
+    Submissions that could not be fully resolved are logged and left out.
+
+    """
+
+    submissions = list(Submission.objects(id__in = submission_ids).exclude(
+        "most_recent",
+        "uploaded_filenames"
+    ))
+
+    assignments = cached_lookup(
+        assignment_cache, Assignment, "id",
+        (i.assignment for i in submissions)
+    )
+
+    test_harnesses = cached_lookup(
+        test_harness_cache, TestHarness, "id",
+        (i.test_harness for i in assignments.values() if i.test_harness)
+    )
+
+    users = cached_lookup(
+        user_cache, User, "email", (i.user for i in submissions)
+    )
+
+    found = set(i.id for i in submissions)
+    for i in submission_ids:
+        if i not in found:
+            logger.warning(
+                "Received test request for non-existant submission [%s].",
+                str(i)
+            )
+
+    result = {}
+    for submission in submissions:
+        assignment = assignments.get(submission.assignment)
+        if assignment is None:
+            logger.error(
+                "Received test request for a submission [%s] referencing "
+                "an invalid assignment [%s].",
+                str(submission.id),
+                str(submission.assignment)
+            )
+            continue
+
+        if not assignment.test_harness:
+            logger.warning(
+                "Received test request for a submission [%s] referencing "
+                "an assignment [%s] that does not have a test harness "
+                "associated with it.",
+                str(submission.id),
+                str(submission.assignment)
+            )
+            continue
+
+        test_harness = test_harnesses.get(assignment.test_harness)
+        if test_harness is None:
+            logger.error(
+                "Received test request for a submission [%s] referencing "
+                "an assignment [%s] that references a non-existant test "
+                "harness [%s].",
+                str(submission.id),
+                str(submission.assignment),
+                str(assignment.test_harness)
+            )
+            continue
+
+        user = users.get(submission.user)
+        if user is None:
+            logger.warning(
+                "Could not find user [%s] who owns submission [%s], personal "
+                "deadlines will not be applied.",
+                submission.user,
+                str(submission.id)
+            )
+
+        result[submission.id] = RequestDocuments(
+            submission, assignment, test_harness, user
+        )
+
+    return result
+
+def personalized_assignment(assignment, user):
+    """
+    Returns the dictionary form of assignment with any of the user's personal
+    deadlines applied. The assignment object itself is left untouched since it
+    may be shared between many requests.
+
+    """
+
+    if user is None:
+        return assignment.to_dict()
+
+    due, due_cutoff = assignment.due, assignment.due_cutoff
+    try:
+        assignment.apply_personal_deadlines(user)
+
+        return assignment.to_dict()
+    finally:
+        assignment.due, assignment.due_cutoff = due, due_cutoff
+
 def match_found(flock_manager, sheep_identity, request):
     logger.info(
         "Sending test request for submission [%s] to sheep [%s].",
@@ -42,241 +275,577 @@ def match_found(flock_manager, sheep_identity, request):
         repr(sheep_identity)
     )
 
-    # Get submission and test harness to send to sheep
-    submission = Submission.objects(id = request.submission_id).exclude(
-        "most_recent",
-        "uploaded_filenames"
-    ).first()
-    assignment = Assignment.objects.get(id = submission.assignment)
-    test_harness = TestHarness.objects.get(id = assignment.test_harness)
+    # Get submission and test harness to send to sheep. They were most likely
+    # loaded when the request was received, but if they weren't (or we've
+    # already used them once) we need to load them again.
+    documents = loaded_documents.pop(request.submission_id, None)
+    if documents is None:
+        documents = load_request_documents([request.submission_id]).get(
+            request.submission_id
+        )
+
+        # The submission (or something it references) has disappeared since
+        # the request was received, there's nothing left to test.
+        if documents is None:
+            flock_manager.discard_request(request)
 
-    # Apply any personal deadlines to the assignment object.
-    user = User.objects.get(email = submission.user)
-    assignment.apply_personal_deadlines(user)
+            return False
 
     data = {
-        "assignment": assignment.to_dict(),
-        "submission": submission.to_dict(),
-        "test_harness": test_harness.to_dict()
+        "assignment":
+            personalized_assignment(documents.assignment, documents.user),
+        "submission": documents.submission.to_dict(),
+        "test_harness": documents.test_harness.to_dict()
     }
 
-    router_send_json(
-        sheep,
-        sheep_identity,
-        FlockMessage("request", data).to_dict()
-    )
+    send_to_sheep(sheep_identity, FlockMessage("request", data))
 
     return True
 
-def main():
-    flock = FlockManager(
-        match_found,
-        config["BLEET_TIMEOUT"],
-        config["SERVICE_TIMEOUT"]
+def is_duplicate_request(flock, submission_id):
+    """
+    Returns True if a request for the given submission is already pending for
+    the test harness its assignment uses now. Only answers from what's in the
+    assignment cache (without counting toward its hits and misses), so a False
+    may still turn out to be a duplicate once the request's documents are
+    loaded.
+
+    """
+
+    for i in flock.pending_requests_for(submission_id):
+        if i.assignment_id is None:
+            continue
+
+        assignment = assignment_cache.peek(ObjectId(i.assignment_id))
+        if assignment is not None and \
+                str(assignment.test_harness) == str(i.harness_id):
+            return True
+
+    return False
+
+def reject_request(result_writer, submission_id):
+    """
+    Turns away a test request because the request queue is full, recording a
+    result for the submission that says so. The student can resubmit it later.
+
+    """
+
+    metrics.requests_rejected.inc(reason = "queue_full")
+    logger.error(
+        "Request queue is full (%d), rejecting test request for submission "
+        "[%s].",
+        config["MAX_QUEUE_DEPTH"],
+        str(submission_id)
     )
 
-    logger.info("Shepherd starting.")
+    result_writer.put(submission_id, {"failed": True, "rejected": True})
+
+def process_test_requests(flock, result_writer, raw_requests):
+    """
+    Transforms a batch of raw test requests received from the outside into
+    InternalTestRequest objects and hands them to the flock manager.
+
+    Reruns are quietly dropped once the request queue reaches
+    RERUN_QUEUE_LIMIT. Once it reaches MAX_QUEUE_DEPTH public submissions are
+    rejected as well (see reject_request()). Final submissions are always
+    accepted.
+
+    """
+
+    submission_ids = []
+    reruns = set()
+    for i in raw_requests:
+        logger.debug("Raw test request: %s", str(i))
+
+        try:
+            request = TestRequest.from_dict(i)
+            submission_id = ObjectId(request.submission_id)
+        except (KeyError, TypeError, InvalidId) as e:
+            logger.warning("Received malformed test request. %s", str(e))
+            continue
+
+        # There's no use loading anything for a request we already have.
+        if is_duplicate_request(flock, submission_id):
+            logger.info(
+                "Received duplicate test request for submission [%s], "
+                "ignoring it.",
+                str(submission_id)
+            )
 
-    while True:
-        # Wait until either the public or sheep socket has messages waiting
-        zmq.select([public, sheep], [], [], timeout = 5)
-
-        # Will grab all of the outstanding messages from the outside and place them
-        # in the request queue
-        while public.getsockopt(zmq.EVENTS) & zmq.POLLIN != 0:
-            request = public.recv_json()
-            logger.debug("Raw test request: %s", str(request))
-
-            request = TestRequest.from_dict(request)
-            try:
-                submission = \
-                    Submission.objects.get(id = ObjectId(request.submission_id))
-            except Submission.DoesNotExist as e:
-                logger.warning(
-                    "Received test request for non-existant submission [%s].",
-                    str(request.submission_id)
-                )
-                continue
-            except bson.errors.InvalidId as e:
-                logger.warning("Received malformed test request. %s", str(e))
-                continue
-
-            try:
-                assignment = Assignment.objects.get(id = submission.assignment)
-            except Assignment.DoesNotExist as e:
-                logger.error(
-                    "Received test request for a submission [%s] referencing "
-                    "an invalid assignment [%s].",
-                    str(submission.id),
-                    str(submission.assignment)
-                )
-                continue
-
-            if not assignment.test_harness:
-                logger.warning(
-                    "Received test request for a submission [%s] referencing "
-                    "an assignment [%s] that does not have a test harness "
-                    "associated with it.",
-                    str(submission.id),
-                    str(submission.assignment)
-                )
-                continue
-
-            try:
-                test_harness = \
-                    TestHarness.objects.get(id = assignment.test_harness)
-            except TestHarness.DoesNotExit as e:
-                logger.error(
-                    "Received test request for a submission [%s] referencing "
-                    "an assignment [%s] that references a non-existant test "
-                    "harness [%s].",
-                    str(submission.id),
-                    str(submission.assignment),
-                    str(assignment.test_harness)
-                )
-                continue
-
-            # Gather all the necessary information from the test request
-            # received from the outside.
-            processed_request = InternalTestRequest(
-                submission.id,
-                test_harness.config.get("galah/timeout",
-                    config["BLEET_TIMEOUT"].seconds),
-                test_harness.config.get("galah/environment", {})
+            continue
+
+        # Don't let the backlog grow without bound. Reruns are shed well
+        # before anything else since they can simply be sent again later.
+        # Whether anything else gets in depends on what kind of submission
+        # it is, which isn't known until it's loaded.
+        queue_depth = flock.queue_depth() + len(submission_ids)
+        if request.rerun and queue_depth >= min(
+                config["RERUN_QUEUE_LIMIT"], config["MAX_QUEUE_DEPTH"]):
+            metrics.requests_rejected.inc(reason = "rerun_shed")
+            logger.warning(
+                "Request queue is too long (%d), shedding rerun of "
+                "submission [%s].",
+                queue_depth,
+                str(submission_id)
             )
+            continue
 
-            logger.info("Received test request.")
+        submission_ids.append(submission_id)
+        if request.rerun:
+            reruns.add(submission_id)
 
-            flock.received_request(processed_request)
+    if not submission_ids:
+        return
 
+    documents = load_request_documents(submission_ids)
 
-        # Will grab all of the outstanding messages from the sheep and process them
-        while sheep.getsockopt(zmq.EVENTS) & zmq.POLLIN != 0:
-            try:
-                sheep_identity, sheep_message = router_recv_json(sheep)
-                sheep_message = FlockMessage.from_dict(sheep_message)
-                logger.debug(
-                    "Received message from sheep: %s",
-                    str(sheep_message)
-                )
-            except ValueError as e:
-                logger.error("Could not decode sheep's message: %s", str(e))
-                logger.debug(
-                    "Exception thrown while decoding sheep's message...",
-                    exc_info = sys.exc_info()
-                )
-                continue
+    logger.debug(
+        "Document cache hits/misses: assignments %d/%d, test harnesses "
+        "%d/%d, users %d/%d.",
+        assignment_cache.hits, assignment_cache.misses,
+        test_harness_cache.hits, test_harness_cache.misses,
+        user_cache.hits, user_cache.misses
+    )
 
-            if sheep_message.type == "distress":
-                logger.warn("Received distress message. Sending bloot.")
-                router_send_json(
-                    sheep, sheep_identity, FlockMessage("bloot", "").to_dict()
-                )
+    for submission_id, i in documents.items():
+        # Reruns are background work, otherwise final submissions take
+        # precedence over public ones.
+        if submission_id in reruns:
+            priority_class = "rerun"
+        else:
+            priority_class = i.submission.test_type or "public"
+
+        # Gather all the necessary information from the test request
+        # received from the outside.
+        processed_request = InternalTestRequest(
+            submission_id,
+            i.test_harness.config.get("galah/timeout",
+                config["SERVICE_TIMEOUT"].total_seconds()),
+            i.test_harness.config.get("galah/environment", {}),
+            i.assignment.due,
+            harness_id = i.test_harness.id,
+            priority_class = priority_class,
+            assignment_id = i.assignment.id
+        )
+
+        # There's no use in testing the same submission twice at once.
+        if flock.is_request_pending(processed_request):
+            logger.info(
+                "Received duplicate test request for submission [%s], "
+                "ignoring it.",
+                str(submission_id)
+            )
 
-            elif sheep_message.type == "bleet":
-                logger.debug(
-                    "Sheep [%s] bleeted. Sending bloot.",
-                    repr(sheep_identity)
-                )
+            continue
 
-                result = flock.sheep_bleeted(sheep_identity)
+        # When the queue is full only final submissions get in. Public ones
+        # are turned away with a result saying so, rather than being left to
+        # wait for results that will never come.
+        if priority_class == "public" and \
+                flock.queue_depth() >= config["MAX_QUEUE_DEPTH"]:
+            reject_request(result_writer, submission_id)
+            continue
 
-                # Under certain circumstances we want to completely ignore a
-                # bleet (see FlockManager.sheep_bleeted() for more details)
-                if result is FlockManager.IGNORE:
-                    logger.debug("Ignoring bleet.")
-                    continue
+        logger.info("Received test request.")
 
-                if not result:
-                    router_send_json(
-                        sheep,
-                        sheep_identity,
-                        FlockMessage("identify", "").to_dict()
-                    )
+        loaded_documents[submission_id] = i
+        flock.received_request(processed_request)
+        metrics.requests_received.inc()
 
-                    logger.info(
-                        "Unrecognized sheep [%s] connected, identify sent.",
-                        repr(sheep_identity)
-                    )
+def handle_bleet(flock, sheep_identity, free_slots, control_frame = False):
+    """
+    Handles a bleet from a sheep. If control_frame is True the bleet came as a
+    control frame (see galah.base.zmqhelpers) and is answered with one.
 
-                    continue
+    """
 
-                router_send_json(
-                    sheep,
-                    sheep_identity,
-                    FlockMessage("bloot", "").to_dict()
-                )
-            elif sheep_message.type == "environment":
-                if not flock.manage_sheep(sheep_identity, sheep_message.body):
-                    logger.warn(
-                        "Received environment from an already-recognized sheep."
-                    )
-            elif sheep_message.type == "result":
-                logger.info("Received test result from sheep.")
-                logger.debug(
-                    "Received test result from sheep: %s",
-                    str(sheep_message.body)
-                )
+    bleet_time = time.time()
 
-                try:
-                    submission_id = ObjectId(sheep_message.body["id"])
-
-                    submission = Submission.objects.get(id = submission_id)
-
-                    test_result = TestResult.from_dict(sheep_message.body)
-                    try:
-                        test_result.save()
-                    except InvalidDocument:
-                        logger.warn(
-                            "Test result is too large for the database.",
-                            exc_info = True
-                        )
-                        test_result = TestResult(failed = True)
-                        test_result.save()
-
-                    submission.test_results = test_result.id
-                    submission.save()
-                except (InvalidId, Submission.DoesNotExist) as e:
-                    logger.warn(
-                        "Could not retrieve submission [%s] for test result "
-                        "received from sheep [%s].",
-                        str(submission_id),
-                        repr(sheep_identity)
-                    )
-
-                    continue
-
-                router_send_json(
-                    sheep,
-                    sheep_identity,
-                    FlockMessage(
-                        "bloot", sheep_message.body["id"]
-                    ).to_dict()
-                )
+    logger.debug("Sheep [%s] bleeted. Sending bloot.", repr(sheep_identity))
+
+    result = flock.sheep_bleeted(sheep_identity, free_slots)
+
+    # Under certain circumstances we want to completely ignore a
+    # bleet (see FlockManager.sheep_bleeted() for more details)
+    if result is FlockManager.IGNORE:
+        logger.debug("Ignoring bleet.")
+        return
+
+    if not result:
+        send_to_sheep(sheep_identity, FlockMessage("identify", ""))
+
+        logger.info(
+            "Unrecognized sheep [%s] connected, identify sent.",
+            repr(sheep_identity)
+        )
+
+        return
+
+    # Sheep that speak in control frames are told how deep our queue is so
+    # they can decide how many virtual machines to keep ready.
+    if control_frame:
+        router_send(sheep, sheep_identity, bloot_frame(flock.queue_depth()))
+    else:
+        send_to_sheep(sheep_identity, FlockMessage("bloot", ""))
+
+    metrics.bleet_latency.observe(time.time() - bleet_time)
 
-                if not flock.sheep_finished(sheep_identity):
-                    logger.info(
-                        "Got result from sheep [%s] who was not processing "
-                        "a test request.",
-                        repr(sheep_identity)
-                    )
+def handle_sheep_message(flock, result_writer, sheep_identity, sheep_message):
+    if sheep_message.type == "distress":
+        logger.warn("Received distress message. Sending bloot.")
+        send_to_sheep(sheep_identity, FlockMessage("bloot", ""))
+
+    elif sheep_message.type == "bleet":
+        # Sheep with many slots tell us how many requests they're ready for
+        # in the body of their bleets.
+        free_slots = sheep_message.body
+        if not isinstance(free_slots, (int, long)):
+            free_slots = None
+
+        handle_bleet(flock, sheep_identity, free_slots)
+    elif sheep_message.type == "environment":
+        # The number of requests the sheep can service at once is sent along
+        # with its environment, but it's not part of the environment.
+        try:
+            environment = dict(sheep_message.body)
+        except (TypeError, ValueError):
+            logger.warn(
+                "Received malformed environment from sheep [%s].",
+                repr(sheep_identity)
+            )
+
+            return
+
+        slots = environment.pop("galah/slots", None)
+        if slots is not None and \
+                (not isinstance(slots, (int, long)) or slots < 1):
+            logger.warn(
+                "Sheep [%s] claims to have %s slots, ignoring its environment.",
+                repr(sheep_identity),
+                repr(slots)
+            )
 
-        # Let the flock manager get rid of any dead or killed sheep.
-        lost_sheep, killed_sheep = flock.cleanup()
+            return
 
-        if lost_sheep:
+        if not flock.manage_sheep(sheep_identity, environment, slots):
             logger.warn(
-                "%d sheep lost due to bleet timeout: %s",
-                len(lost_sheep),
-                str([repr(i) for i in lost_sheep])
+                "Received environment from an already-recognized sheep."
+            )
+    elif sheep_message.type == "result_chunk":
+        try:
+            key = (sheep_identity, str(sheep_message.body["id"]))
+            data = sheep_message.body["data"]
+        except (KeyError, TypeError):
+            logger.warn(
+                "Received malformed result chunk from sheep [%s].",
+                repr(sheep_identity)
             )
 
-        if killed_sheep:
+            return
+
+        stash = result_chunks.setdefault(
+            key, {"size": 0, "chunks": [], "truncated": False}
+        )
+
+        if stash["size"] + len(data) > config["MAX_OVERFLOW_SIZE"]:
+            stash["truncated"] = True
+        else:
+            stash["size"] += len(data)
+            stash["chunks"].append(data)
+    elif sheep_message.type == "result":
+        logger.info("Received test result from sheep.")
+        logger.debug(
+            "Received test result from sheep: %s",
+            str(sheep_message.body)
+        )
+
+        try:
+            submission_id = ObjectId(sheep_message.body["id"])
+        except (InvalidId, KeyError, TypeError) as e:
             logger.warn(
-                "%d sheep lost due to request timeout: %s",
-                len(killed_sheep),
-                str([repr(i) for i in killed_sheep])
+                "Received test result with a bad submission id from "
+                "sheep [%s].",
+                repr(sheep_identity)
+            )
+
+            return
+
+        # Put back together any output that was too large to send along
+        # with the result.
+        expected_chunks = sheep_message.body.pop("overflow_chunks", 0)
+        stash = result_chunks.pop(
+            (sheep_identity, str(sheep_message.body["id"])), None
+        )
+
+        overflow = None
+        if stash is not None or expected_chunks:
+            if stash is None or stash["truncated"] or \
+                    len(stash["chunks"]) != expected_chunks:
+                logger.warn(
+                    "Overflow for submission [%s] is incomplete or too "
+                    "large, discarding it.",
+                    str(submission_id)
+                )
+            else:
+                overflow = "".join(stash["chunks"])
+
+        # The result is written to the database in the background so
+        # we can get back to the flock right away. If the writer has
+        # fallen too far behind we have no choice but to wait on it.
+        result_writer.put(submission_id, sheep_message.body, overflow)
+
+        send_to_sheep(
+            sheep_identity, FlockMessage("bloot", sheep_message.body["id"])
+        )
+
+        if not flock.sheep_finished(sheep_identity, submission_id):
+            logger.info(
+                "Got result from sheep [%s] who was not processing "
+                "a test request.",
+                repr(sheep_identity)
+            )
+
+def drain_sheep(flock, result_writer, budget):
+    """
+    Processes up to budget messages waiting on the sheep socket. Returns True
+    if the budget ran out before the socket was empty.
+
+    """
+
+    for _ in xrange(budget):
+        if not sheep.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            return False
+
+        sheep_identity, raw_message = router_recv(sheep)
+
+        # Heartbeats skip decoding entirely.
+        if raw_message[:1] == BLEET_FRAME:
+            handle_bleet(
+                flock,
+                sheep_identity,
+                parse_bleet_frame(raw_message),
+                control_frame = True
+            )
+
+            continue
+
+        try:
+            sheep_message, wire_format = decode(raw_message)
+            sheep_message = FlockMessage.from_dict(sheep_message)
+            if wire_format is not None:
+                sheep_wire_formats[sheep_identity] = wire_format
+            logger.debug(
+                "Received message from sheep: %s",
+                str(sheep_message)
             )
+        except ValueError as e:
+            logger.error("Could not decode sheep's message: %s", str(e))
+            logger.debug(
+                "Exception thrown while decoding sheep's message...",
+                exc_info = sys.exc_info()
+            )
+            continue
+
+        handle_sheep_message(flock, result_writer, sheep_identity, sheep_message)
+
+    return bool(sheep.getsockopt(zmq.EVENTS) & zmq.POLLIN)
+
+def answer_query(flock, query):
+    """
+    Returns the answer to a query sent to the public socket. "status" asks
+    how backed up we are and "dead_letters" asks which requests we gave up on.
+
+    """
+
+    if query == "status":
+        return flock.status()
+    elif query == "dead_letters":
+        return flock.dead_letter_summary()
+
+    return {"error": "Unknown query %s." % repr(query)}
+
+def drain_public(flock, result_writer, budget):
+    """
+    Processes up to budget messages waiting on the public socket. Queries are
+    answered right away and test requests are processed as a single batch.
+    Returns True if the budget ran out before the socket was empty.
+
+    """
+
+    raw_requests = []
+    for _ in xrange(budget):
+        if not public.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            break
+
+        try:
+            identity, message = router_recv_json(public)
+        except (ValueError, RuntimeError) as e:
+            logger.warning("Could not decode public message: %s", str(e))
+            continue
+
+        if isinstance(message, dict) and "query" in message:
+            router_send_json(
+                public, identity, answer_query(flock, message["query"])
+            )
+        else:
+            raw_requests.append(message)
+
+    if raw_requests:
+        process_test_requests(flock, result_writer, raw_requests)
+
+    return bool(public.getsockopt(zmq.EVENTS) & zmq.POLLIN)
+
+def cleanup(flock):
+    # Let the flock manager get rid of any dead or killed sheep.
+    lost_sheep, killed_sheep, dead_requests = flock.cleanup()
+
+    for i in lost_sheep + killed_sheep:
+        sheep_wire_formats.pop(i, None)
+
+    # Any overflow we were collecting from these sheep will never be
+    # finished.
+    if lost_sheep or killed_sheep:
+        gone = set(lost_sheep + killed_sheep)
+        for key in [k for k in result_chunks if k[0] in gone]:
+            del result_chunks[key]
+
+    metrics.sheep_lost.inc(len(lost_sheep), reason = "bleet_timeout")
+    metrics.sheep_lost.inc(len(killed_sheep), reason = "service_timeout")
+    metrics.requests_dead.inc(len(dead_requests))
+
+    if lost_sheep:
+        logger.warn(
+            "%d sheep lost due to bleet timeout: %s",
+            len(lost_sheep),
+            str([repr(i) for i in lost_sheep])
+        )
+
+    if killed_sheep:
+        logger.warn(
+            "%d sheep lost due to request timeout: %s",
+            len(killed_sheep),
+            str([repr(i) for i in killed_sheep])
+        )
+
+    if dead_requests:
+        logger.error(
+            "%d test requests given up on after %d retries: %s",
+            len(dead_requests),
+            flock.max_retries,
+            str([str(i.submission_id) for i in dead_requests])
+        )
+
+def serve_stats():
+    """Answers every request waiting on the stats socket."""
+
+    while stats.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+        # Whatever was asked, the answer is the same.
+        stats.recv()
+
+        for name, cache in (("assignment", assignment_cache),
+                ("test_harness", test_harness_cache), ("user", user_cache)):
+            metrics.cache_hits.set(cache.hits, cache = name)
+            metrics.cache_misses.set(cache.misses, cache = name)
+
+        stats.send(metrics.registry.render())
+
+def restore_requests(flock, journal):
+    """
+    Places every request recovered from the journal back into the flock
+    manager, loading their documents in a single batch.
+
+    """
+
+    requests = journal.replay()
+    if not requests:
+        return
+
+    loaded_documents.update(
+        load_request_documents([i.submission_id for i, _ in requests])
+    )
+
+    flock.restore_requests(requests)
+
+    logger.info("Restored %d test requests from the journal.", len(requests))
+
+def main():
+    journal = None
+    if config["REQUEST_JOURNAL"]:
+        journal = RequestJournal(
+            config["REQUEST_JOURNAL"], config["REQUEST_JOURNAL_FSYNC"]
+        )
+
+    flock = FlockManager(
+        match_found,
+        config["BLEET_TIMEOUT"],
+        config["SERVICE_TIMEOUT"],
+        deadline_horizon = config["DEADLINE_PRIORITY_HORIZON"],
+        deadline_weight = config["DEADLINE_PRIORITY_WEIGHT"],
+        max_retries = config["MAX_REQUEST_RETRIES"],
+        retry_backoff = config["REQUEST_RETRY_BACKOFF"],
+        dead_letter_limit = config["DEAD_LETTER_LIMIT"],
+        service_grace = config["SERVICE_TIMEOUT_GRACE"],
+        journal = journal,
+        class_delays = config["PRIORITY_CLASS_DELAYS"],
+        timeout_tracker = config["TIMEOUT_TRACKER"],
+        wheel_resolution = config["TIMER_WHEEL_RESOLUTION"]
+    )
+
+    if journal is not None:
+        restore_requests(flock, journal)
+
+    result_writer = ResultWriter(
+        config["RESULT_QUEUE_SIZE"],
+        config["RESULT_BATCH_SIZE"],
+        max_attempts = config["RESULT_WRITE_ATTEMPTS"],
+        dead_letter_limit = config["DEAD_LETTER_LIMIT"]
+    )
+    result_writer.start()
+
+    metrics.request_queue_depth.set_function(flock.queue_depth)
+    metrics.idle_sheep.set_function(flock.idle_sheep)
+    metrics.busy_sheep.set_function(flock.busy_sheep)
+    metrics.result_queue_depth.set_function(result_writer.qsize)
+
+    poller = zmq.Poller()
+    poller.register(sheep, zmq.POLLIN)
+    poller.register(public, zmq.POLLIN)
+    if stats is not None:
+        poller.register(stats, zmq.POLLIN)
+
+    budget = config["SOCKET_DRAIN_BUDGET"]
+
+    logger.info("Shepherd starting.")
+
+    while True:
+        # Sleep until a message arrives or it's time for some sheep to time
+        # out, whichever comes first.
+        deadline = flock.next_deadline()
+        if deadline is None:
+            timeout = None
+        else:
+            timeout = max(0, int(math.ceil(
+                (deadline - datetime.datetime.now()).total_seconds() * 1000
+            )))
+
+        poller.poll(timeout)
+
+        # Take turns servicing each socket, handling at most budget messages
+        # from one before moving on to the other, so a flood of test requests
+        # can't keep us from answering the sheep's bleets (or vice versa). The
+        # sheep always go first.
+        more_waiting = True
+        while more_waiting:
+            more_waiting = drain_sheep(flock, result_writer, budget)
+            more_waiting = \
+                drain_public(flock, result_writer, budget) or more_waiting
+
+            deadline = flock.next_deadline()
+            if deadline is not None and deadline <= datetime.datetime.now():
+                cleanup(flock)
+
+        if stats is not None:
+            serve_stats()
 
 if __name__ == "__main__":
     main()
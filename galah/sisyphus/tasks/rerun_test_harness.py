@@ -6,13 +6,43 @@ from galah.db.models import Submission, Assignment
 
 # Set up configuration and logging
 from galah.base.config import load_config
-from galah.shepherd.api import send_test_request
+from galah.shepherd.api import send_test_request, get_queue_status, \
+    find_shepherd
 config = load_config("sisyphus")
 shepherd_config = load_config("shepherd")
 
 import logging
 logger = logging.getLogger("galah.sisyphus.rerun_test_harness")
 
+def _wait_for_shepherd(assignment_id):
+    """
+    Blocks until the shepherd responsible for the given assignment has room
+    for another rerun. The shepherd sheds reruns once its queue reaches
+    RERUN_QUEUE_LIMIT, so there's no sense sending them any faster than it
+    can work through them.
+
+    """
+
+    while True:
+        status = get_queue_status(
+            find_shepherd(assignment_id, shepherd_config["PUBLIC_SOCKET"])
+        )
+
+        if status is None:
+            # Can't tell how busy the shepherd is, fall back to pacing the
+            # requests ourselves.
+            time.sleep(30)
+            return
+
+        if status["queue_depth"] < shepherd_config["RERUN_QUEUE_LIMIT"]:
+            return
+
+        logger.debug(
+            "Shepherd has %d requests queued, waiting to send rerun.",
+            status["queue_depth"]
+        )
+        time.sleep(10)
+
 def _rerun_test_harness(assignment):
     try:
         # Get assignment
@@ -38,12 +68,15 @@ def _rerun_test_harness(assignment):
 
         # Send a bunch of test requests to shepherd to be rerun.
         for i in submissions:
+            _wait_for_shepherd(assn.id)
+
             i.test_request_timestamp = datetime.datetime.now()
             i.save()
             logger.info("Sent test request to shepherd for %s" % str(i.id))
-            send_test_request(shepherd_config["PUBLIC_SOCKET"], i.id)
-
-            time.sleep(30)
+            send_test_request(
+                shepherd_config["PUBLIC_SOCKET"], i.id, rerun = True,
+                assignment_id = assn.id
+            )
     except Exception as e:
         logger.error(str(e))
 
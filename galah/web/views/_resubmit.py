@@ -7,6 +7,7 @@ from flask import abort, request, flash, redirect, url_for
 from flask.ext.login import current_user
 from galah.db.models import Submission, Assignment, TestResult
 from galah.shepherd.api import send_test_request
+from _upload_submission import flash_estimated_wait
 from galah.web.util import is_url_on_site, GalahWebAdapter
 import datetime
 import logging
@@ -65,7 +66,10 @@ def resubmit_submission(assignment_id, submission_id):
     # Recheck that this assignment has a test harness before signaling shepherd.
     if (assignment.test_harness):
         submission.test_request_timestamp = datetime.datetime.now()
-        send_test_request(config["PUBLIC_SOCKET"], submission.id)
+        send_test_request(
+            config["PUBLIC_SOCKET"], submission.id,
+            assignment_id = assignment.id
+        )
         logger.info("Resending test request to shepherd for %s" \
                         % str(submission.id))
 
@@ -80,5 +84,6 @@ def resubmit_submission(assignment_id, submission_id):
         submission.save()
 
         flash("Successfully resubmitted files.", category = "message")
+        flash_estimated_wait(assignment.id)
 
     return redirect(redirect_to)
@@ -8,12 +8,14 @@ from flask import abort, render_template, request, flash, redirect, jsonify, \
                   url_for
 from galah.db.models import Submission, Assignment
 from galah.base.pretty import pretty_list, plural_if
-from galah.shepherd.api import send_test_request
+from galah.shepherd.api import send_test_request, get_cached_queue_status, \
+                             find_shepherd
 from galah.web.util import is_url_on_site, GalahWebAdapter
 from werkzeug import secure_filename
 import os.path
 import subprocess
 import datetime
+import math
 import shutil
 import tempfile
 import logging
@@ -27,6 +29,31 @@ from _view_assignment import SimpleArchiveForm
 logger = \
     GalahWebAdapter(logging.getLogger("galah.web.views.upload_submissions"))
 
+def flash_estimated_wait(assignment_id):
+    """
+    Lets the user know roughly how long they'll be waiting for their test
+    results. Nothing is shown if the shepherd can't be reached or doesn't know
+    yet. The estimate may be a few seconds old so we don't hold up the page
+    waiting on the shepherd.
+
+    """
+
+    status = get_cached_queue_status(
+        find_shepherd(assignment_id, config["PUBLIC_SOCKET"])
+    )
+    if status is None or status.get("estimated_wait") is None:
+        return
+
+    minutes = int(math.ceil(status["estimated_wait"] / 60.0))
+    if minutes == 0:
+        return
+
+    flash(
+        "Estimated wait for test results: %d %s." %
+            (minutes, plural_if("minute", minutes)),
+        category = "message"
+    )
+
 @app.route("/assignments/<assignment_id>/upload", methods = ["POST"])
 @account_type_required(("student", "teacher", "teaching_assistant"))
 def upload_submission(assignment_id):
@@ -144,7 +171,10 @@ def upload_submission(assignment_id):
 
     # Tell shepherd to start running tests if there is a test_harness.
     if assignment.test_harness:
-        send_test_request(config["PUBLIC_SOCKET"], new_submission.id)
+        send_test_request(
+            config["PUBLIC_SOCKET"], new_submission.id,
+            assignment_id = assignment.id
+        )
 
     # Communicate to the next page what submission was just added.
     flash(str(new_submission.id), category = "new_submission")
@@ -158,5 +188,8 @@ def upload_submission(assignment_id):
         category = "message"
     )
 
+    if assignment.test_harness:
+        flash_estimated_wait(assignment.id)
+
     # Everything seems to have gone well
     return redirect(redirect_to)
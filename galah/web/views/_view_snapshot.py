@@ -107,6 +107,9 @@ def view_snapshot(assignment_id, student_email):
                 i.status = "Waiting for test results..." 
             else:
                 i.status = "Test request timed out"
+        elif (i.test_results and i.test_results_obj.rejected):
+            i.status = "Test request rejected"
+            i.show_resubmit = True
         elif (i.test_results and i.test_results_obj.failed):
             i.status = "Tests Failed"
             i.show_resubmit = True
@@ -0,0 +1,146 @@
+import unittest
+import datetime
+
+import galah.shepherd.flockmanager as flockmanager
+from galah.shepherd.flockmanager import FlockManager
+from galah.base.flockmail import InternalTestRequest
+from galah.base.config import load_config
+
+class FlockManagerTestCase(unittest.TestCase):
+    """
+    Runs a FlockManager against a fake clock. Every match is accepted and
+    recorded in self.matches as (sheep identity, submission id) tuples.
+
+    """
+
+    def setUp(self):
+        self.now = 1000.0
+        self._monotonic = flockmanager.monotonic
+        flockmanager.monotonic = lambda: self.now
+
+        self.matches = []
+
+    def tearDown(self):
+        flockmanager.monotonic = self._monotonic
+
+    def match_found(self, flock, identity, request):
+        self.matches.append((identity, request.submission_id))
+
+        return True
+
+    def make_flock(self, **kwargs):
+        return FlockManager(
+            self.match_found,
+            datetime.timedelta(seconds = 30),
+            datetime.timedelta(seconds = 60),
+            **kwargs
+        )
+
+class TestDeadLetters(FlockManagerTestCase):
+    def test_dead_letter_summary(self):
+        flock = self.make_flock(max_retries = 0)
+        flock.manage_sheep("sheep", {})
+        flock.received_request(
+            InternalTestRequest("submission", 10, {}, harness_id = "harness")
+        )
+
+        # The sheep never returns a result.
+        self.now += 1000
+        _, killed_sheep, dead_requests = flock.cleanup()
+        self.assertEqual(killed_sheep, ["sheep"])
+        self.assertEqual(len(dead_requests), 1)
+
+        summary = flock.dead_letter_summary()
+        self.assertEqual(len(summary), 1)
+        self.assertEqual(summary[0]["submission_id"], "submission")
+        self.assertEqual(summary[0]["harness_id"], "harness")
+
+        # The time must survive being sent as JSON.
+        given_up = datetime.datetime.strptime(
+            summary[0]["time"], "%Y-%m-%dT%H:%M:%S.%f"
+        )
+        self.assertTrue(
+            datetime.datetime.now() - given_up < datetime.timedelta(minutes = 1)
+        )
+
+        self.assertEqual(flock.status()["dead_letters"], 1)
+
+class TestRetries(FlockManagerTestCase):
+    def test_retry_keeps_arrival_time(self):
+        flock = self.make_flock(max_retries = 1)
+        flock.manage_sheep("sheep", {})
+
+        arrival_time = datetime.datetime.now() - datetime.timedelta(hours = 1)
+        request = InternalTestRequest("submission", 10, {})
+        flock.received_request(request, arrival_time)
+        self.assertEqual(self.matches, [("sheep", "submission")])
+
+        # The sheep dies while servicing the request, which is retried right
+        # away since there's no backoff.
+        self.now += 1000
+        flock.cleanup()
+
+        self.assertEqual(request.retries, 1)
+        self.assertEqual(flock._request_queue[request], arrival_time)
+
+class TestPriorities(FlockManagerTestCase):
+    def test_default_ordering(self):
+        # Final submissions first, then submissions for whatever is due
+        # soonest, then reruns.
+        config = load_config("shepherd")
+        flock = self.make_flock(
+            deadline_horizon = config["DEADLINE_PRIORITY_HORIZON"],
+            deadline_weight = config["DEADLINE_PRIORITY_WEIGHT"],
+            class_delays = config["PRIORITY_CLASS_DELAYS"]
+        )
+
+        now = datetime.datetime.now()
+        for submission_id, priority_class, due in [
+                ("rerun", "rerun", now),
+                ("public due later", "public", None),
+                ("public due soon", "public",
+                    now + datetime.timedelta(minutes = 10)),
+                ("final", "final", None)]:
+            flock.received_request(InternalTestRequest(
+                submission_id, 10, {}, deadline = due,
+                priority_class = priority_class
+            ))
+
+        flock.manage_sheep("sheep", {}, 4)
+
+        self.assertEqual(
+            [i[1] for i in self.matches],
+            ["final", "public due soon", "public due later", "rerun"]
+        )
+
+class TestBusySheep(FlockManagerTestCase):
+    def test_busy_one_slot_multiplexed_sheep_is_answered(self):
+        # A multiplexer with a single consumer advertises one slot and keeps
+        # bleeting while that consumer runs a test. If its bleets went
+        # unanswered it would reconnect under a new identity and its result
+        # would arrive from a sheep we don't know.
+        flock = self.make_flock()
+        flock.manage_sheep("multiplexer", {}, 1)
+        flock.received_request(InternalTestRequest("submission", 50, {}))
+        self.assertEqual(self.matches, [("multiplexer", "submission")])
+
+        for _ in xrange(3):
+            self.now += 15
+            self.assertIs(flock.sheep_bleeted("multiplexer", 0), True)
+            self.assertEqual(flock.cleanup(), ([], [], []))
+
+        self.assertTrue(flock.sheep_finished("multiplexer", "submission"))
+        self.assertIs(flock.sheep_bleeted("multiplexer", 1), True)
+        self.assertEqual(flock.idle_sheep(), 1)
+
+    def test_busy_older_sheep_is_ignored(self):
+        # Sheep that don't advertise their slots bleet only when idle, so a
+        # bleet while busy raced the request we sent it.
+        flock = self.make_flock()
+        flock.manage_sheep("sheep", {})
+        flock.received_request(InternalTestRequest("submission", 50, {}))
+
+        self.assertIs(flock.sheep_bleeted("sheep"), FlockManager.IGNORE)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# Copyright 2012-2013 John Sullivan
+# Copyright 2012-2013 Other contributors as noted in the CONTRIBUTORS file
+#
+# This file is part of Galah.
+#
+# Galah is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Galah is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Galah.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compares PriorityDict and IndexedPriorityDict on a workload like the
+shepherd's bleet queue: a flock of sheep bleeting over and over, with the
+oldest bleet checked after every one (as the shepherd does when deciding how
+long to sleep) and the occasional sheep being lost.
+
+"""
+
+from galah.base.prioritydict import PriorityDict, IndexedPriorityDict
+from optparse import OptionParser
+import datetime
+import random
+import time
+
+def bleet_workload(queue_type, now, sheep, bleets, seed):
+    random.seed(seed)
+
+    queue = queue_type()
+    for i in xrange(sheep):
+        queue[i] = now(i)
+
+    # The longest any single bleet took. PriorityDict occasionally rebuilds
+    # its entire heap, which shows up here.
+    worst = 0
+
+    start = time.time()
+
+    for i in xrange(bleets):
+        bleet_start = time.time()
+
+        queue[random.randrange(sheep)] = now(sheep + i)
+        queue.smallest()
+
+        # Every so often a sheep is lost and another takes its place.
+        if i % 1000 == 0:
+            identity = queue.pop_smallest().value
+            queue[identity] = now(sheep + i)
+
+        worst = max(worst, time.time() - bleet_start)
+
+    return time.time() - start, worst, len(queue._heap)
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--sheep", type = "int", default = 1000)
+    parser.add_option("--bleets", type = "int", default = 200000)
+    parser.add_option("--seed", type = "int", default = 0)
+    options, args = parser.parse_args()
+
+    epoch = datetime.datetime(2013, 1, 1)
+    as_datetime = lambda i: epoch + datetime.timedelta(milliseconds = i)
+    as_float = lambda i: i / 1000.0
+
+    cases = [
+        ("PriorityDict, datetime priorities", PriorityDict, as_datetime),
+        ("IndexedPriorityDict, datetime priorities", IndexedPriorityDict,
+            as_datetime),
+        ("IndexedPriorityDict, float priorities", IndexedPriorityDict,
+            as_float)
+    ]
+
+    print "%d sheep, %d bleets" % (options.sheep, options.bleets)
+    for name, queue_type, now in cases:
+        elapsed, worst, heap_size = bleet_workload(
+            queue_type, now, options.sheep, options.bleets, options.seed
+        )
+
+        print "%-45s %8.3fs %10.0f bleets/s %8.3fms worst %8d heap entries" % (
+            name, elapsed, options.bleets / elapsed, worst * 1000, heap_size
+        )
+
+if __name__ == "__main__":
+    main()